@@ -7,4 +7,9 @@ if ([string]::IsNullOrEmpty($POSTGRES_HOST) -or [string]::IsNullOrEmpty($POSTGRE
     exit 1
 }
 
+# The embedding column is sized from the embedding model configured for the deployment
+$env:OPENAI_EMBED_HOST = ((azd env get-values | Select-String -Pattern "^OPENAI_EMBED_HOST=") -replace '^OPENAI_EMBED_HOST="?|"$', '')
+$env:AZURE_OPENAI_EMBED_MODEL_DIMENSIONS = ((azd env get-values | Select-String -Pattern "^AZURE_OPENAI_EMBED_MODEL_DIMENSIONS=") -replace '^AZURE_OPENAI_EMBED_MODEL_DIMENSIONS="?|"$', '')
+$env:OPENAICOM_EMBED_MODEL_DIMENSIONS = ((azd env get-values | Select-String -Pattern "^OPENAICOM_EMBED_MODEL_DIMENSIONS=") -replace '^OPENAICOM_EMBED_MODEL_DIMENSIONS="?|"$', '')
+
 python ./src/fastapi_app/setup_postgres_database.py --host $POSTGRES_HOST --username $POSTGRES_USERNAME --password $POSTGRES_PASSWORD
\ No newline at end of file
@@ -2,4 +2,9 @@ POSTGRES_HOST=$(azd env get-values | grep POSTGRES_HOST | sed 's/="/=/' | sed 's
 POSTGRES_USERNAME=$(azd env get-values | grep POSTGRES_USERNAME | sed 's/="/=/' | sed 's/"$//' | sed 's/^POSTGRES_USERNAME=//')
 POSTGRES_DATABASE=$(azd env get-values | grep POSTGRES_DATABASE | sed 's/="/=/' | sed 's/"$//' | sed 's/^POSTGRES_DATABASE=//')
 
+# The embedding column is sized from the embedding model configured for the deployment
+export OPENAI_EMBED_HOST=$(azd env get-values | grep '^OPENAI_EMBED_HOST=' | sed 's/="/=/' | sed 's/"$//' | sed 's/^OPENAI_EMBED_HOST=//')
+export AZURE_OPENAI_EMBED_MODEL_DIMENSIONS=$(azd env get-values | grep '^AZURE_OPENAI_EMBED_MODEL_DIMENSIONS=' | sed 's/="/=/' | sed 's/"$//' | sed 's/^AZURE_OPENAI_EMBED_MODEL_DIMENSIONS=//')
+export OPENAICOM_EMBED_MODEL_DIMENSIONS=$(azd env get-values | grep '^OPENAICOM_EMBED_MODEL_DIMENSIONS=' | sed 's/="/=/' | sed 's/"$//' | sed 's/^OPENAICOM_EMBED_MODEL_DIMENSIONS=//')
+
 python ./src/fastapi_app/setup_postgres_database.py --host $POSTGRES_HOST --username $POSTGRES_USERNAME --database $POSTGRES_DATABASE
\ No newline at end of file
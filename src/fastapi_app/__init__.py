@@ -7,9 +7,15 @@ from dotenv import load_dotenv
 from environs import Env
 from fastapi import FastAPI
 
+from .answer_cache import AnswerCache
+from .embedding_cache import EmbeddingCache
 from .globals import global_storage
 from .openai_clients import create_openai_chat_client, create_openai_embed_client
 from .postgres_engine import create_postgres_engine_from_env
+from .postgres_models import check_embedding_dimensions, check_embedding_index, set_embedding_dimensions
+from .postgres_searcher import PostgresSearcher
+from .rag_advanced import AdvancedRAGChat
+from .search_arguments_cache import SearchArgumentsCache
 
 logger = logging.getLogger("ragapp")
 
@@ -46,6 +52,62 @@ async def lifespan(app: FastAPI):
     global_storage.openai_embed_client = openai_embed_client
     global_storage.openai_embed_model = openai_embed_model
     global_storage.openai_embed_dimensions = openai_embed_dimensions
+    set_embedding_dimensions(openai_embed_dimensions)
+
+    if (embedding_cache_size := int(os.getenv("EMBEDDING_CACHE_SIZE", "1000"))) > 0:
+        global_storage.embedding_cache = EmbeddingCache(
+            max_size=embedding_cache_size,
+            ttl_seconds=int(os.getenv("EMBEDDING_CACHE_TTL", "3600")),
+            # The shared tier lives in the embedding_cache table created by setup_postgres_database.py
+            engine=engine if os.getenv("EMBEDDING_CACHE_POSTGRES", "false").lower() == "true" else None,
+        )
+
+    if (search_arguments_cache_size := int(os.getenv("SEARCH_ARGUMENTS_CACHE_SIZE", "1000"))) > 0:
+        global_storage.search_arguments_cache = SearchArgumentsCache(
+            max_size=search_arguments_cache_size,
+            ttl_seconds=int(os.getenv("SEARCH_ARGUMENTS_CACHE_TTL", "3600")),
+            # The shared tier lives in the search_arguments_cache table created by setup_postgres_database.py
+            engine=engine if os.getenv("SEARCH_ARGUMENTS_CACHE_POSTGRES", "false").lower() == "true" else None,
+        )
+
+    if os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true":
+        # The answer_cache table and the trigger that empties it are created by setup_postgres_database.py
+        global_storage.answer_cache = AnswerCache(
+            engine,
+            similarity_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95")),
+            ttl_seconds=int(os.getenv("ANSWER_CACHE_TTL", "3600")),
+        )
+
+    # Fail fast if query embeddings don't fit the embedding column, or if the searcher's distance operator
+    # can't use the embedding index, rather than failing or scanning every row on each search
+    embedding_index_type = os.getenv("EMBEDDING_INDEX_TYPE", "vector")
+    embedding_distance_metric = os.getenv("EMBEDDING_DISTANCE_METRIC", "cosine")
+    async with engine.connect() as conn:
+        await check_embedding_dimensions(conn, openai_embed_dimensions)
+        await check_embedding_index(conn, embedding_index_type, embedding_distance_metric)
+
+    # The searcher and chat objects hold no per-request state, so build them (and read the prompts) once per worker
+    global_storage.searcher = PostgresSearcher(
+        engine,
+        embedding_index_type=embedding_index_type,
+        distance_metric=embedding_distance_metric,
+        binary_oversampling=int(os.getenv("EMBEDDING_BINARY_OVERSAMPLING", "4")),
+        explain_sample_rate=float(os.getenv("SEARCH_EXPLAIN_SAMPLE_RATE", "0")),
+        explain_slow_ms=float(os.getenv("SEARCH_EXPLAIN_SLOW_MS", "200")),
+    )
+    global_storage.advanced_chat = AdvancedRAGChat(
+        searcher=global_storage.searcher,
+        openai_chat_client=global_storage.openai_chat_client,
+        chat_model=global_storage.openai_chat_model,
+        chat_deployment=global_storage.openai_chat_deployment,
+        openai_embed_client=global_storage.openai_embed_client,
+        embed_deployment=global_storage.openai_embed_deployment,
+        embed_model=global_storage.openai_embed_model,
+        embed_dimensions=global_storage.openai_embed_dimensions,
+        embedding_cache=global_storage.embedding_cache,
+        answer_cache=global_storage.answer_cache,
+        search_arguments_cache=global_storage.search_arguments_cache,
+    )
 
     yield
 
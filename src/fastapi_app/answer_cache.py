@@ -0,0 +1,79 @@
+import hashlib
+import json
+import logging
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Any
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+from .metrics import CACHE_LOOKUPS
+from .postgres_models import AnswerCacheEntry
+
+logger = logging.getLogger("ragapp")
+
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    context: dict[str, Any]
+    similarity: float
+
+
+class AnswerCache:
+    """Cache of answers to single-turn questions, looked up by the cosine similarity of the question embeddings.
+
+    Entries live in the answer_cache table, which a trigger on items empties whenever items change.
+    """
+
+    def __init__(self, engine: AsyncEngine, *, similarity_threshold: float = 0.95, ttl_seconds: int = 3600):
+        self.async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+
+    @staticmethod
+    def make_scope(**settings) -> str:
+        """Hash the settings that an answer depends on besides the question, such as the chat flow and overrides.
+
+        Answers are only reused for questions with the same scope.
+        """
+        return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+    async def get(self, embedding: list[float], scope: str) -> CachedAnswer | None:
+        distance = AnswerCacheEntry.embedding.cosine_distance(embedding)
+        try:
+            async with self.async_session_maker() as session:
+                row = (
+                    await session.execute(
+                        select(AnswerCacheEntry.answer, AnswerCacheEntry.context, distance)
+                        .where(
+                            AnswerCacheEntry.scope == scope,
+                            AnswerCacheEntry.created_at > func.now() - timedelta(seconds=self.ttl_seconds),
+                        )
+                        .order_by(distance)
+                        .limit(1)
+                    )
+                ).first()
+        except Exception as e:
+            logger.warning("Failed to read from the answer cache: %s", e)
+            row = None
+        if row is not None and 1 - row[2] >= self.similarity_threshold:
+            CACHE_LOOKUPS.labels("answer", "shared").inc()
+            return CachedAnswer(answer=row[0], context=row[1], similarity=1 - row[2])
+        CACHE_LOOKUPS.labels("answer", "miss").inc()
+        return None
+
+    async def set(self, embedding: list[float], scope: str, answer: str, context: dict[str, Any]):
+        try:
+            async with self.async_session_maker() as session:
+                # Purge expired entries as new ones come in, so the table (and each lookup's scan) stays small
+                await session.execute(
+                    delete(AnswerCacheEntry).where(
+                        AnswerCacheEntry.created_at <= func.now() - timedelta(seconds=self.ttl_seconds)
+                    )
+                )
+                session.add(AnswerCacheEntry(scope=scope, embedding=embedding, answer=answer, context=context))
+                await session.commit()
+        except Exception as e:
+            logger.warning("Failed to write to the answer cache: %s", e)
@@ -11,6 +11,7 @@ class Message(BaseModel):
 class ChatRequest(BaseModel):
     messages: list[Message]
     context: dict = {}
+    stream: bool = False
 
 
 class ThoughtStep(BaseModel):
@@ -1,27 +1,45 @@
+import json
+import logging
+from collections.abc import AsyncGenerator
+
 import fastapi
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 
 from .api_models import ChatRequest
 from .globals import global_storage
-from .postgres_searcher import PostgresSearcher
-from .rag_advanced import AdvancedRAGChat
+from .metrics import generate_metrics
+
+logger = logging.getLogger("ragapp")
 
 router = fastapi.APIRouter()
 
 
+async def format_as_ndjson(events: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+    try:
+        async for event in events:
+            yield json.dumps(jsonable_encoder(event), ensure_ascii=False) + "\n"
+    except Exception as e:
+        # The status code has already been sent, so report the error as the last line of the stream
+        logger.exception("Exception while generating response stream: %s", e)
+        yield json.dumps({"error": str(e)}) + "\n"
+
+
 @router.post("/chat")
 async def chat_handler(chat_request: ChatRequest):
-    ragchat = AdvancedRAGChat(
-        searcher=PostgresSearcher(global_storage.engine),
-        openai_chat_client=global_storage.openai_chat_client,
-        chat_model=global_storage.openai_chat_model,
-        chat_deployment=global_storage.openai_chat_deployment,
-        openai_embed_client=global_storage.openai_embed_client,
-        embed_deployment=global_storage.openai_embed_deployment,
-        embed_model=global_storage.openai_embed_model,
-        embed_dimensions=global_storage.openai_embed_dimensions,
-    )
+    ragchat = global_storage.advanced_chat
 
     messages = [message.model_dump() for message in chat_request.messages]
     overrides = chat_request.context.get("overrides", {})
+    if chat_request.stream:
+        return StreamingResponse(
+            format_as_ndjson(ragchat.run_stream(messages, overrides=overrides)), media_type="application/x-ndjson"
+        )
     response = await ragchat.run(messages, overrides=overrides)
     return response
+
+
+@router.get("/metrics")
+async def metrics_handler():
+    content, content_type = generate_metrics()
+    return fastapi.Response(content=content, media_type=content_type)
@@ -0,0 +1,27 @@
+import hashlib
+
+from sqlalchemy import Row
+
+from .postgres_models import EmbeddingCacheEntry
+from .two_tier_cache import TwoTierCache
+
+
+class EmbeddingCache(TwoTierCache[list[float]]):
+    """Cache of query embeddings, with an in-memory LRU per worker and an optional table shared by all workers."""
+
+    name = "embedding"
+    entry_model = EmbeddingCacheEntry
+
+    @staticmethod
+    def make_key(text: str, embed_model: str, embed_dimensions) -> str:
+        normalized_text = " ".join(text.split()).casefold()
+        return hashlib.sha256(f"{embed_model}\0{embed_dimensions}\0{normalized_text}".encode()).hexdigest()
+
+    def value_columns(self) -> list:
+        return [EmbeddingCacheEntry.embedding]
+
+    def value_from_row(self, row: Row) -> list[float]:
+        return row.embedding.tolist()
+
+    def value_to_columns(self, embedding: list[float]) -> dict:
+        return {"embedding": embedding}
@@ -2,25 +2,84 @@ from typing import (
     TypedDict,
 )
 
+from .embedding_cache import EmbeddingCache
+from .single_flight import SingleFlight
+
+SUPPORTED_DIMENSIONS_MODEL = {
+    "text-embedding-ada-002": False,
+    "text-embedding-3-small": True,
+    "text-embedding-3-large": True,
+}
+
+# Embedding requests in flight in this worker, keyed on the model, dimensions and text
+embedding_calls = SingleFlight()
+
+
+class ExtraArgs(TypedDict, total=False):
+    dimensions: int
+
+
+def dimensions_args(embed_model: str, embedding_dimensions: int) -> ExtraArgs:
+    return {"dimensions": embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[embed_model] else {}
+
 
 async def compute_text_embedding(
-    q: str, openai_client, embed_model: str, embed_deployment: str = None, embedding_dimensions: int = 1536
+    q: str,
+    openai_client,
+    embed_model: str,
+    embed_deployment: str = None,
+    embedding_dimensions: int = 1536,
+    cache: EmbeddingCache | None = None,
 ):
-    SUPPORTED_DIMENSIONS_MODEL = {
-        "text-embedding-ada-002": False,
-        "text-embedding-3-small": True,
-        "text-embedding-3-large": True,
-    }
+    # Concurrent requests for the same text in this worker share one lookup and embeddings request
+    return await embedding_calls.run(
+        (embed_deployment or embed_model, embedding_dimensions, q),
+        compute_uncoalesced_text_embedding,
+        q,
+        openai_client,
+        embed_model,
+        embed_deployment,
+        embedding_dimensions,
+        cache,
+    )
 
-    class ExtraArgs(TypedDict, total=False):
-        dimensions: int
 
-    dimensions_args: ExtraArgs = {"dimensions": embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[embed_model] else {}
+async def compute_uncoalesced_text_embedding(
+    q: str,
+    openai_client,
+    embed_model: str,
+    embed_deployment: str = None,
+    embedding_dimensions: int = 1536,
+    cache: EmbeddingCache | None = None,
+):
+    if cache is not None:
+        cache_key = cache.make_key(q, embed_model, embedding_dimensions)
+        if (cached_embedding := await cache.get(cache_key)) is not None:
+            return cached_embedding
 
     embedding = await openai_client.embeddings.create(
         # Azure OpenAI takes the deployment name as the model name
         model=embed_deployment if embed_deployment else embed_model,
         input=q,
-        **dimensions_args,
+        **dimensions_args(embed_model, embedding_dimensions),
     )
+    if cache is not None:
+        await cache.set(cache_key, embedding.data[0].embedding)
     return embedding.data[0].embedding
+
+
+async def compute_text_embeddings(
+    texts: list[str],
+    openai_client,
+    embed_model: str,
+    embed_deployment: str = None,
+    embedding_dimensions: int = 1536,
+) -> list[list[float]]:
+    """Compute the embeddings of several texts with a single embeddings request."""
+    embeddings = await openai_client.embeddings.create(
+        # Azure OpenAI takes the deployment name as the model name
+        model=embed_deployment if embed_deployment else embed_model,
+        input=texts,
+        **dimensions_args(embed_model, embedding_dimensions),
+    )
+    return [embedding.embedding for embedding in sorted(embeddings.data, key=lambda embedding: embedding.index)]
@@ -8,6 +8,11 @@ class Global:
         self.openai_embed_dimensions = None
         self.openai_chat_deployment = None
         self.openai_embed_deployment = None
+        self.embedding_cache = None
+        self.answer_cache = None
+        self.search_arguments_cache = None
+        self.searcher = None
+        self.advanced_chat = None
 
 
 global_storage = Global()
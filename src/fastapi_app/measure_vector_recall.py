@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import Float, func, select, text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from fastapi_app.openai_clients import get_openai_embed_dimensions
+from fastapi_app.postgres_engine import create_postgres_engine_from_env
+from fastapi_app.postgres_models import EMBEDDING_DISTANCE_METRICS, Item, set_embedding_dimensions
+from fastapi_app.postgres_searcher import PostgresSearcher
+
+logger = logging.getLogger("ragapp")
+
+
+async def measure_vector_recall(
+    embedding_index_type: str,
+    distance_metric: str = "cosine",
+    sample_size: int = 50,
+    top: int = 20,
+    binary_oversampling: int = 4,
+) -> float:
+    """Compare the vector search for an index type against an exact (sequential scan) search.
+
+    The embeddings of randomly sampled items are used as queries. Returns the mean recall@top.
+    """
+    engine = await create_postgres_engine_from_env()
+    set_embedding_dimensions(get_openai_embed_dimensions())
+    searcher = PostgresSearcher(
+        engine,
+        embedding_index_type=embedding_index_type,
+        distance_metric=distance_metric,
+        binary_oversampling=binary_oversampling,
+    )
+    distance_operator = EMBEDDING_DISTANCE_METRICS[distance_metric][1]
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    try:
+        async with session_maker() as session:
+            query_vectors = (
+                await session.scalars(
+                    select(Item.embedding)
+                    .where(Item.embedding.is_not(None))
+                    .order_by(func.random())
+                    .limit(sample_size)
+                )
+            ).all()
+
+        recalls = []
+        for query_vector in query_vectors:
+            query_vector = list(query_vector)
+            approximate_ids = {item.id for item in await searcher.search(None, query_vector, query_top=top)}
+            async with session_maker() as session:
+                # Without index scans, Postgres computes the distance to every row
+                await session.execute(text("SET LOCAL enable_indexscan = off"))
+                exact_distance = Item.embedding.op(distance_operator, return_type=Float)(query_vector)
+                exact_ids = set((await session.scalars(select(Item.id).order_by(exact_distance).limit(top))).all())
+            recalls.append(len(approximate_ids & exact_ids) / len(exact_ids))
+    finally:
+        await engine.dispose()
+
+    if not recalls:
+        raise ValueError("No items have embeddings")
+    recall = sum(recalls) / len(recalls)
+    logger.info("Recall@%d for %s index over %d queries: %.3f", top, embedding_index_type, len(recalls), recall)
+    return recall
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Measure the recall of the vector search against an exact search")
+    parser.add_argument(
+        "--embedding-index-type",
+        type=str,
+        help="Index type the searcher queries, as created by setup_postgres_database.py",
+        default=os.getenv("EMBEDDING_INDEX_TYPE", "vector"),
+    )
+    parser.add_argument(
+        "--embedding-distance-metric",
+        type=str,
+        choices=list(EMBEDDING_DISTANCE_METRICS),
+        help="Distance metric the searcher orders by",
+        default=os.getenv("EMBEDDING_DISTANCE_METRIC", "cosine"),
+    )
+    parser.add_argument("--sample-size", type=int, help="Number of sampled items used as queries", default=50)
+    # With the default oversampling, the bit index's binary pass fetches 80 candidates, more than the default
+    # hnsw.ef_search of 40, so the default run also checks that the searcher raises ef_search to match
+    parser.add_argument("--top", type=int, help="Number of results compared per query", default=20)
+    parser.add_argument(
+        "--binary-oversampling",
+        type=int,
+        help="Candidates fetched per result by the binary pass of the bit index",
+        default=int(os.getenv("EMBEDDING_BINARY_OVERSAMPLING", "4")),
+    )
+    args = parser.parse_args()
+
+    await measure_vector_recall(
+        args.embedding_index_type,
+        args.embedding_distance_metric,
+        args.sample_size,
+        args.top,
+        args.binary_oversampling,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    load_dotenv(override=True)
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Latency buckets from 5ms (cache hits, indexed queries) up to a minute (slow chat completions)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram(
+    "ragapp_stage_duration_seconds",
+    "Time a chat request spends in each stage: query_rewrite, embedding, search, build_messages, answer_generation",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+SEARCH_QUERY_SECONDS = Histogram(
+    "ragapp_search_query_duration_seconds",
+    "Duration of each SQL query run by PostgresSearcher.search: set_ef_search, rank and hydrate",
+    ["query"],
+    buckets=LATENCY_BUCKETS,
+)
+POOL_CHECKOUT_SECONDS = Histogram(
+    "ragapp_pool_checkout_duration_seconds",
+    "Time spent waiting for an idle connection in the SQLAlchemy pool, excluding the time to open new connections",
+    buckets=LATENCY_BUCKETS,
+)
+TOKENS = Counter(
+    "ragapp_tokens",
+    "Tokens used by chat completions, by step (query_rewrite or answer) and kind (prompt or completion)",
+    ["model", "step", "kind"],
+)
+CACHE_LOOKUPS = Counter(
+    "ragapp_cache_lookups",
+    "Cache lookups by cache and result: local (in-memory hit), shared (Postgres hit) or miss",
+    ["cache", "result"],
+)
+# With several gunicorn workers, report the sum of the workers that are alive
+IN_FLIGHT_REQUESTS = Gauge(
+    "ragapp_in_flight_requests", "Chat requests being processed", ["mode"], multiprocess_mode="livesum"
+)
+
+
+def record_token_usage(model: str, step: str, prompt_tokens: int, completion_tokens: int):
+    TOKENS.labels(model, step, "prompt").inc(prompt_tokens)
+    TOKENS.labels(model, step, "completion").inc(completion_tokens)
+
+
+def generate_metrics() -> tuple[bytes, str]:
+    """Return the metrics in the Prometheus text format, and its content type.
+
+    When PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py), the metrics of all workers are combined.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
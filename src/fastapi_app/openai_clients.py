@@ -37,6 +37,14 @@ async def create_openai_chat_client(azure_credential):
     return openai_chat_client, openai_chat_model
 
 
+def get_openai_embed_dimensions() -> int:
+    """Return the configured embedding dimensions, which also set the width of the items.embedding column."""
+    prefix = "AZURE_OPENAI" if os.getenv("OPENAI_EMBED_HOST") == "azure" else "OPENAICOM"
+    # The infrastructure outputs *_EMBED_MODEL_DIMENSIONS, so accept both names
+    dimensions = os.getenv(f"{prefix}_EMBED_DIMENSIONS") or os.getenv(f"{prefix}_EMBED_MODEL_DIMENSIONS")
+    return int(dimensions) if dimensions and int(dimensions) > 0 else 1536
+
+
 async def create_openai_embed_client(azure_credential):
 
     OPENAI_EMBED_HOST = os.getenv("OPENAI_EMBED_HOST")
@@ -51,9 +59,8 @@ async def create_openai_embed_client(azure_credential):
             azure_deployment=os.getenv("AZURE_OPENAI_EMBED_DEPLOYMENT"),
         )
         openai_embed_model = os.getenv("AZURE_OPENAI_EMBED_MODEL")
-        openai_embed_dimensions = os.getenv("AZURE_OPENAI_EMBED_DIMENSIONS")
     else:
         openai_embed_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAICOM_KEY"))
         openai_embed_model = os.getenv("OPENAICOM_EMBED_MODEL")
-        openai_embed_dimensions = os.getenv("OPENAICOM_EMBED_DIMENSIONS")
+    openai_embed_dimensions = get_openai_embed_dimensions()
     return openai_embed_client, openai_embed_model, openai_embed_dimensions
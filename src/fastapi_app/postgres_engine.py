@@ -1,24 +1,125 @@
+import asyncio
+import inspect
 import logging
 import os
+import time
 
+from azure.core.credentials import AccessToken
 from azure.identity.aio import DefaultAzureCredential
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.util.queue import AsyncAdaptedQueue
+
+from .metrics import POOL_CHECKOUT_SECONDS
 
 logger = logging.getLogger("ragapp")
 
+AZURE_POSTGRES_SCOPE = "https://ossrdbms-aad.database.windows.net/.default"
+
+
+class AzurePostgresTokenProvider:
+    """Async callable that returns an Entra ID access token for Azure Database for PostgreSQL.
+
+    The token is cached and fetched again shortly before it expires, so that new pool connections
+    opened by long-lived workers keep authenticating. Works with both sync and async Azure credentials.
+    """
+
+    def __init__(self, azure_credential, refresh_margin_seconds: int = 300):
+        self.azure_credential = azure_credential
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self._token: AccessToken | None = None
+        self._lock = asyncio.Lock()
+
+    def _needs_refresh(self) -> bool:
+        return self._token is None or self._token.expires_on - time.time() < self.refresh_margin_seconds
+
+    async def __call__(self) -> str:
+        if self._needs_refresh():
+            async with self._lock:
+                # Another connection may have refreshed the token while we waited for the lock
+                if self._needs_refresh():
+                    token = self.azure_credential.get_token(AZURE_POSTGRES_SCOPE)
+                    if inspect.isawaitable(token):
+                        token = await token
+                    self._token = token
+                    logger.info("Fetched a new Azure Database for PostgreSQL access token")
+        return self._token.token
+
+
+def pool_size_for_connection_budget(max_connections: int, workers: int, replicas: int = 1, reserved: int = 10) -> int:
+    """Return a per-worker pool size that keeps replicas * workers * pool_size <= max_connections - reserved.
+
+    reserved covers superuser_reserved_connections, the provider's own connections and ad-hoc admin sessions.
+    """
+    return max(1, (max_connections - reserved) // (workers * replicas))
+
+
+class TimedAsyncAdaptedQueue(AsyncAdaptedQueue):
+    """Queue of idle pool connections, reporting how long each checkout waits for one.
+
+    Opening a new connection when the queue is empty happens outside the queue, so it isn't counted as waiting.
+    """
+
+    def get(self, block: bool = True, timeout: float | None = None):
+        start_time = time.perf_counter()
+        try:
+            return super().get(block, timeout)
+        finally:
+            POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - start_time)
+
 
-async def create_postgres_engine(*, host, username, database, password, sslmode, azure_credential) -> AsyncEngine:
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """The default pool of async engines, with a queue that reports how long checkouts wait for a connection."""
+
+    _queue_class = TimedAsyncAdaptedQueue
+
+
+class CredentialOwningAsyncEngine(AsyncEngine):
+    """Async engine that closes the Azure credential its connections authenticate with when it's disposed."""
+
+    __slots__ = ("azure_credential",)
+
+    def __init__(self, sync_engine, azure_credential):
+        super().__init__(sync_engine)
+        self.azure_credential = azure_credential
+
+    async def dispose(self, close: bool = True) -> None:
+        await super().dispose(close)
+        # With close=False the pool is only dereferenced (e.g. after a fork), and the engine stays usable
+        if close:
+            await self.azure_credential.close()
+
+
+async def create_postgres_engine(
+    *,
+    host,
+    username,
+    database,
+    password,
+    sslmode,
+    azure_credential,
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_timeout: float = 30,
+    pool_recycle: int = -1,
+    pool_pre_ping: bool = False,
+    prepared_statement_cache_size: int = 100,
+) -> AsyncEngine:
 
     if host.endswith(".database.azure.com"):
         logger.info("Authenticating to Azure Database for PostgreSQL using Azure Identity...")
         if azure_credential is None:
             raise ValueError("Azure credential must be provided for Azure Database for PostgreSQL")
-        token = await azure_credential.get_token("https://ossrdbms-aad.database.windows.net/.default")
-        password = token.token
+        token_provider = AzurePostgresTokenProvider(azure_credential)
+        # Fetch the first token now so that authentication problems surface at startup
+        await token_provider()
+        DATABASE_URI = f"postgresql+asyncpg://{username}@{host}/{database}"
     else:
         logger.info("Authenticating to PostgreSQL using password...")
+        token_provider = None
+        DATABASE_URI = f"postgresql+asyncpg://{username}:{password}@{host}/{database}"
 
-    DATABASE_URI = f"postgresql+asyncpg://{username}:{password}@{host}/{database}"
     # Specify SSL mode if needed
     if sslmode:
         DATABASE_URI += f"?ssl={sslmode}"
@@ -26,16 +127,45 @@ async def create_postgres_engine(*, host, username, database, password, sslmode,
     engine = create_async_engine(
         DATABASE_URI,
         echo=False,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pool_pre_ping,
+        poolclass=TimedAsyncAdaptedQueuePool,
+        # Size of the per-connection LRU cache of prepared statements kept by SQLAlchemy's asyncpg dialect.
+        # (asyncpg's own statement_cache_size doesn't apply, since the dialect prepares statements itself.)
+        connect_args={"prepared_statement_cache_size": prepared_statement_cache_size},
     )
 
+    if token_provider is not None:
+
+        @event.listens_for(engine.sync_engine, "do_connect")
+        def provide_token(dialect, conn_rec, cargs, cparams):
+            # asyncpg calls (and awaits) a callable password each time it opens a connection
+            cparams["password"] = token_provider
+
     return engine
 
 
 async def create_postgres_engine_from_env(azure_credential=None) -> AsyncEngine:
-    must_close = False
-    if azure_credential is None and os.environ["POSTGRES_HOST"].endswith(".database.azure.com"):
+    owns_credential = azure_credential is None and os.environ["POSTGRES_HOST"].endswith(".database.azure.com")
+    if owns_credential:
         azure_credential = DefaultAzureCredential()
-        must_close = True
+
+    # Each worker process has its own pool, so with POSTGRES_MAX_CONNECTIONS set the default pool size
+    # is derived from the server's connection budget split across all workers on all replicas.
+    if max_connections := os.getenv("POSTGRES_MAX_CONNECTIONS"):
+        default_pool_size = pool_size_for_connection_budget(
+            int(max_connections),
+            workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+            replicas=int(os.getenv("POSTGRES_APP_REPLICAS", "1")),
+            reserved=int(os.getenv("POSTGRES_RESERVED_CONNECTIONS", "10")),
+        )
+        default_max_overflow = 0
+    else:
+        default_pool_size = 5
+        default_max_overflow = 10
 
     engine = await create_postgres_engine(
         host=os.environ["POSTGRES_HOST"],
@@ -44,19 +174,24 @@ async def create_postgres_engine_from_env(azure_credential=None) -> AsyncEngine:
         password=os.environ["POSTGRES_PASSWORD"],
         sslmode=os.environ.get("POSTGRES_SSL"),
         azure_credential=azure_credential,
+        pool_size=int(os.getenv("POSTGRES_POOL_SIZE", default_pool_size)),
+        max_overflow=int(os.getenv("POSTGRES_MAX_OVERFLOW", default_max_overflow)),
+        pool_timeout=float(os.getenv("POSTGRES_POOL_TIMEOUT", "30")),
+        pool_recycle=int(os.getenv("POSTGRES_POOL_RECYCLE", "-1")),
+        pool_pre_ping=os.getenv("POSTGRES_POOL_PRE_PING", "false").lower() == "true",
+        prepared_statement_cache_size=int(os.getenv("POSTGRES_STATEMENT_CACHE_SIZE", "100")),
     )
 
-    if must_close:
-        await azure_credential.close()
-
+    if owns_credential:
+        # The credential refreshes tokens for new connections, so it's closed along with the engine
+        engine = CredentialOwningAsyncEngine(engine.sync_engine, azure_credential)
     return engine
 
 
 async def create_postgres_engine_from_args(args, azure_credential=None) -> AsyncEngine:
-    must_close = False
-    if azure_credential is None and args.host.endswith(".database.azure.com"):
+    owns_credential = azure_credential is None and args.host.endswith(".database.azure.com")
+    if owns_credential:
         azure_credential = DefaultAzureCredential()
-        must_close = True
 
     engine = await create_postgres_engine(
         host=args.host,
@@ -67,7 +202,7 @@ async def create_postgres_engine_from_args(args, azure_credential=None) -> Async
         azure_credential=azure_credential,
     )
 
-    if must_close:
-        await azure_credential.close()
-
+    if owns_credential:
+        # The credential refreshes tokens for new connections, so it's closed along with the engine
+        engine = CredentialOwningAsyncEngine(engine.sync_engine, azure_credential)
     return engine
@@ -1,10 +1,15 @@
 from __future__ import annotations
 
-from dataclasses import asdict
+import hashlib
+from dataclasses import fields
+from datetime import datetime
 
 from pgvector.sqlalchemy import Vector
-from sqlalchemy import Index
+from sqlalchemy import Computed, DateTime, Index, func, text
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from sqlalchemy.ext.asyncio import AsyncConnection
 from sqlalchemy.orm import DeclarativeBase, Mapped, MappedAsDataclass, mapped_column
+from sqlalchemy.types import UserDefinedType
 
 
 # Define the models
@@ -20,14 +25,31 @@ class Item(Base):
     name: Mapped[str] = mapped_column()
     description: Mapped[str] = mapped_column()
     price: Mapped[float] = mapped_column()
-    embedding: Mapped[Vector] = mapped_column(Vector(1536))  # ada-002
+    # The width follows the configured embedding dimensions, see set_embedding_dimensions().
+    # Items may be loaded without an embedding and embedded later by update_embeddings.py.
+    embedding: Mapped[Vector] = mapped_column(Vector(1536), nullable=True)
+    # Pre-tokenized description for full text search, kept up to date by Postgres.
+    # Only the search query uses it, so loading items doesn't fetch it.
+    description_tsv: Mapped[str] = mapped_column(
+        TSVECTOR,
+        Computed("to_tsvector('english', description)", persisted=True),
+        init=False,
+        repr=False,
+        deferred=True,
+    )
+    # What the stored embedding was computed from, so unchanged items can be skipped when re-embedding
+    embedding_hash: Mapped[str | None] = mapped_column(default=None, repr=False)
+    embedding_model: Mapped[str | None] = mapped_column(default=None, repr=False)
+    embedding_dimensions: Mapped[int | None] = mapped_column(default=None, repr=False)
 
     def to_dict(self, include_embedding: bool = False):
-        model_dict = asdict(self)
-        if include_embedding:
+        excluded = {"description_tsv", "embedding_hash", "embedding_model", "embedding_dimensions"}
+        if not include_embedding:
+            excluded.add("embedding")
+        # Unlike asdict(), this doesn't touch description_tsv, whose deferred load can't run outside of a session
+        model_dict = {field.name: getattr(self, field.name) for field in fields(self) if field.name not in excluded}
+        if model_dict.get("embedding") is not None:
             model_dict["embedding"] = model_dict["embedding"].tolist()
-        else:
-            del model_dict["embedding"]
         return model_dict
 
     def to_str_for_rag(self):
@@ -36,12 +58,172 @@ class Item(Base):
     def to_str_for_embedding(self):
         return f"Name: {self.name} Description: {self.description} Type: {self.type}"
 
+    def hash_for_embedding(self):
+        return hashlib.sha256(self.to_str_for_embedding().encode()).hexdigest()
 
-# Define HNSW index to support vector similarity search through the vector_cosine_ops access method (cosine distance).
-index = Index(
-    "hnsw_index_for_innerproduct_item_embedding",
-    Item.embedding,
-    postgresql_using="hnsw",
-    postgresql_with={"m": 16, "ef_construction": 64},
-    postgresql_ops={"embedding": "vector_ip_ops"},
+    def embedding_is_stale(self, embed_model: str, embed_dimensions: int | None) -> bool:
+        return (
+            self.embedding_hash != self.hash_for_embedding()
+            or self.embedding_model != embed_model
+            or self.embedding_dimensions != embed_dimensions
+        )
+
+
+class HalfVector(UserDefinedType):
+    """pgvector's halfvec type, used to cast embeddings to half precision in queries."""
+
+    cache_ok = True
+
+    def __init__(self, dim: int | None = None):
+        super().__init__()
+        self.dim = dim
+
+    def get_col_spec(self, **kw):
+        return "HALFVEC" if self.dim is None else f"HALFVEC({self.dim})"
+
+
+def set_embedding_dimensions(dimensions: int):
+    """Set the width of the embedding columns, used when creating tables and indexes and when binding vectors."""
+    Item.__table__.c.embedding.type = Vector(dimensions)
+    AnswerCacheEntry.__table__.c.embedding.type = Vector(dimensions)
+
+
+class EmbeddingCacheEntry(Base):
+    __tablename__ = "embedding_cache"
+    # Hash of the embedding model, dimensions and normalized query text
+    key: Mapped[str] = mapped_column(primary_key=True)
+    embedding: Mapped[Vector] = mapped_column(Vector())
+    # Indexed for the deletion of expired entries
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), index=True, init=False
+    )
+
+
+class SearchArgumentsCacheEntry(Base):
+    __tablename__ = "search_arguments_cache"
+    # Hash of the chat model and the query rewrite messages
+    key: Mapped[str] = mapped_column(primary_key=True)
+    query_text: Mapped[str | None] = mapped_column()
+    filters: Mapped[list] = mapped_column(JSONB)
+    # Indexed for the deletion of expired entries
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), index=True, init=False
+    )
+
+
+class AnswerCacheEntry(Base):
+    __tablename__ = "answer_cache"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, init=False)
+    # Hash of the chat flow, models and overrides that the answer was generated with
+    scope: Mapped[str] = mapped_column(index=True)
+    # Embedding of the question, as wide as Item.embedding, see set_embedding_dimensions()
+    embedding: Mapped[Vector] = mapped_column(Vector(1536))
+    answer: Mapped[str] = mapped_column()
+    # Data points and thoughts of the original response
+    context: Mapped[dict] = mapped_column(JSONB)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), init=False)
+
+
+class BackfillCheckpoint(Base):
+    __tablename__ = "backfill_checkpoints"
+    name: Mapped[str] = mapped_column(primary_key=True)
+    # All items with an id up to and including last_id have been processed
+    last_id: Mapped[int] = mapped_column()
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), init=False
+    )
+
+
+# HNSW indexes on the embedding, one per EMBEDDING_INDEX_TYPE. They are created by setup_postgres_database.py
+# rather than create_all(), since their definition depends on the configured index type, metric and dimensions.
+EMBEDDING_INDEX_NAMES = {
+    # Full precision index on the embedding column
+    "vector": "hnsw_index_for_vector_item_embedding",
+    # Half precision index on an expression, which takes half the memory of the full precision index
+    "halfvec": "hnsw_index_for_halfvec_item_embedding",
+    # Binary quantized index (1 bit per dimension) for a Hamming distance first pass, re-ranked by exact distance
+    "bit": "hnsw_index_for_bit_item_embedding",
+}
+# Indexes created by earlier versions of setup_postgres_database.py
+LEGACY_EMBEDDING_INDEX_NAMES = ["hnsw_index_for_innerproduct_item_embedding"]
+HNSW_OPTIONS = "m = 16, ef_construction = 64"
+
+# For each EMBEDDING_DISTANCE_METRIC, the operator class suffix of the index and the pgvector distance operator.
+# Postgres only uses an HNSW index when the query orders by the operator of the index's operator class.
+EMBEDDING_DISTANCE_METRICS = {
+    "cosine": ("cosine_ops", "<=>"),
+    "inner_product": ("ip_ops", "<#>"),
+    "l2": ("l2_ops", "<->"),
+}
+
+
+def embedding_index_opclass(index_type: str, distance_metric: str) -> str:
+    if index_type == "bit":
+        # The binary pass always uses Hamming distance, the metric only applies to the re-ranking
+        return "bit_hamming_ops"
+    return f"{index_type}_{EMBEDDING_DISTANCE_METRICS[distance_metric][0]}"
+
+
+def create_embedding_index_sql(index_type: str, dimensions: int, distance_metric: str = "cosine") -> str:
+    name = EMBEDDING_INDEX_NAMES[index_type]
+    opclass = embedding_index_opclass(index_type, distance_metric)
+    # The searcher must use the same expressions, with the same dimensions, for the planner to use these indexes
+    if index_type == "halfvec":
+        indexed = f"(embedding::halfvec({dimensions}))"
+    elif index_type == "bit":
+        indexed = f"(binary_quantize(embedding)::bit({dimensions}))"
+    else:
+        indexed = "embedding"
+    return f"CREATE INDEX IF NOT EXISTS {name} ON items USING hnsw ({indexed} {opclass}) WITH ({HNSW_OPTIONS})"
+
+
+async def get_embedding_index_opclass(conn: AsyncConnection, index_type: str) -> str | None:
+    """Return the operator class of the embedding index for index_type, or None if the index doesn't exist."""
+    return await conn.scalar(
+        text(
+            "SELECT opclass.opcname FROM pg_index "
+            "JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "JOIN pg_opclass opclass ON opclass.oid = pg_index.indclass[0] "
+            "WHERE pg_class.relname = :index_name"
+        ),
+        {"index_name": EMBEDDING_INDEX_NAMES[index_type]},
+    )
+
+
+async def get_embedding_column_dimensions(conn: AsyncConnection, table_name: str = "items") -> int | None:
+    """Return the width of the embedding column of table_name, or None if the table doesn't exist."""
+    # For vector columns, the type modifier is the number of dimensions
+    return await conn.scalar(
+        text("SELECT atttypmod FROM pg_attribute WHERE attrelid = to_regclass(:table_name) AND attname = 'embedding'"),
+        {"table_name": table_name},
+    )
+
+
+async def check_embedding_dimensions(conn: AsyncConnection, dimensions: int):
+    """Raise if items.embedding has another width than the configured embedding dimensions."""
+    actual = await get_embedding_column_dimensions(conn)
+    if actual != dimensions:
+        raise RuntimeError(
+            f"items.embedding has {actual} dimensions but {dimensions} are configured, so every vector search "
+            "would fail. Run setup_postgres_database.py --reset-embeddings and then update_embeddings.py."
+        )
+
+
+async def check_embedding_index(conn: AsyncConnection, index_type: str, distance_metric: str):
+    """Raise if the embedding index is missing or was built for another distance metric than the searcher uses."""
+    expected = embedding_index_opclass(index_type, distance_metric)
+    actual = await get_embedding_index_opclass(conn, index_type)
+    if actual != expected:
+        found = f"uses {actual}" if actual else "does not exist"
+        raise RuntimeError(
+            f"The {index_type} embedding index {found}, but EMBEDDING_DISTANCE_METRIC={distance_metric} needs "
+            f"{expected}, so vector searches could not use it. Run setup_postgres_database.py to rebuild the index."
+        )
+
+
+# Define GIN index to support full text search on the stored tsvector column.
+fulltext_index = Index(
+    "gin_index_for_item_description_tsv",
+    Item.description_tsv,
+    postgresql_using="gin",
 )
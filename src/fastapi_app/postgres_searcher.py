@@ -1,91 +1,362 @@
-from pgvector.utils import to_db
-from sqlalchemy import Float, Integer, select, text
-from sqlalchemy.ext.asyncio import async_sessionmaker
+import json
+import logging
+import operator
+import random
+import time
 
-from .postgres_models import Item
+from sqlalchemy import ColumnElement, Float, Select, cast, func, literal, select, text
+from sqlalchemy.dialects.postgresql import BIT
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from .metrics import SEARCH_QUERY_SECONDS
+from .postgres_models import EMBEDDING_DISTANCE_METRICS, HalfVector, Item
+from .single_flight import SingleFlight
+
+logger = logging.getLogger("ragapp")
+
+# Only these columns and operators may appear in filters produced by the query rewriter
+FILTER_COLUMNS = {
+    "price": (Item.price, float),
+    "brand": (Item.brand, str),
+}
+FILTER_OPERATORS = {
+    ">": operator.gt,
+    "<": operator.lt,
+    ">=": operator.ge,
+    "<=": operator.le,
+    "==": operator.eq,
+    "=": operator.eq,
+    "!=": operator.ne,
+}
+# pgvector's default and maximum hnsw.ef_search. An HNSW index scan returns at most ef_search rows.
+HNSW_DEFAULT_EF_SEARCH = 40
+HNSW_MAX_EF_SEARCH = 1000
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) of a statement, keeping its bound parameters."""
+
+    inherit_cache = False
+
+    def __init__(self, statement: Select):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element: Explain, compiler, **kw):
+    return "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def summarize_plan(plan: dict) -> dict:
+    """Summarize a JSON query plan: indexes used, sequential scans, rows scanned, buffers and time per CTE."""
+    indexes = []
+    sequential_scans = []
+    cte_times_ms = {}
+    rows_scanned = 0
+
+    def visit(node: dict):
+        nonlocal rows_scanned
+        loops = node.get("Actual Loops", 1)
+        if index_name := node.get("Index Name"):
+            indexes.append(index_name)
+        if node["Node Type"] == "Seq Scan":
+            sequential_scans.append(node.get("Relation Name"))
+        if node["Node Type"].endswith("Scan") and "Relation Name" in node:
+            rows_scanned += (node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0)) * loops
+        # Postgres inlines CTEs that are referenced once into subqueries, otherwise they are separate subplans
+        if (subplan_name := node.get("Subplan Name", "")).startswith("CTE "):
+            cte_times_ms[subplan_name.removeprefix("CTE ")] = node.get("Actual Total Time", 0) * loops
+        elif node["Node Type"] == "Subquery Scan":
+            cte_times_ms[node.get("Alias")] = node.get("Actual Total Time", 0) * loops
+        for child in node.get("Plans", []):
+            visit(child)
+
+    root = plan["Plan"]
+    visit(root)
+    return {
+        "indexes": indexes,
+        "sequential_scans": sequential_scans,
+        "rows_scanned": rows_scanned,
+        # The root node's buffer counts include those of all its children
+        "shared_buffers_hit": root.get("Shared Hit Blocks", 0),
+        "shared_buffers_read": root.get("Shared Read Blocks", 0),
+        "cte_times_ms": cte_times_ms,
+        "planning_time_ms": plan.get("Planning Time", 0),
+        "execution_time_ms": plan.get("Execution Time", 0),
+    }
 
 
 class PostgresSearcher:
 
-    def __init__(self, engine):
+    def __init__(
+        self,
+        engine,
+        embedding_index_type: str = "vector",
+        distance_metric: str = "cosine",
+        binary_oversampling: int = 4,
+        explain_sample_rate: float = 0.0,
+        explain_slow_ms: float = 200.0,
+    ):
         self.async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+        self.embedding_index_type = embedding_index_type
+        # The operator must match the operator class of the HNSW index, see check_embedding_index()
+        self.distance_operator = EMBEDDING_DISTANCE_METRICS[distance_metric][1]
+        # With the bit index, how many more candidates the binary pass fetches than are needed after re-ranking
+        self.binary_oversampling = binary_oversampling
+        # Fraction of searches that are also explained, and the execution time above which plans are logged
+        self.explain_sample_rate = explain_sample_rate
+        self.explain_slow_ms = explain_slow_ms
+        # Brand names for the rule-based query rewriter, reloaded after brands_ttl_seconds
+        self.brands_ttl_seconds = 300
+        self._brands: list[str] = []
+        self._brands_expire_at = 0.0
+        self.search_calls = SingleFlight()
+
+    def embedding_distance(self, query_vector: list[float]) -> ColumnElement[float]:
+        """Distance between item embeddings and the query, written to match the configured HNSW index."""
+        if self.embedding_index_type == "halfvec":
+            half_vector = HalfVector(Item.embedding.type.dim)
+            query = cast(literal(query_vector, Item.embedding.type), half_vector)
+            return cast(Item.embedding, half_vector).op(self.distance_operator, return_type=Float)(query)
+        return Item.embedding.op(self.distance_operator, return_type=Float)(query_vector)
 
-    def build_filter_clause(self, filters) -> tuple[str, str]:
+    def build_vector_query(
+        self, query_vector: list[float], filter_clauses: list[ColumnElement[bool]], limit: int
+    ) -> Select:
+        """Build the query ranking the top `limit` items by vector distance to the query."""
+        if self.embedding_index_type == "bit":
+            # First pass: over-fetch candidates by Hamming distance between binary quantized vectors (bit index),
+            # then re-rank those candidates by exact distance on the full precision embeddings.
+            bit = BIT(Item.embedding.type.dim)
+            query = cast(literal(query_vector, Item.embedding.type), Item.embedding.type)
+            hamming_distance = cast(func.binary_quantize(Item.embedding), bit).op("<~>", return_type=Float)(
+                func.binary_quantize(query)
+            )
+            candidates = (
+                select(Item.id, Item.embedding)
+                .where(*filter_clauses)
+                .order_by(hamming_distance)
+                .limit(limit * self.binary_oversampling)
+                .subquery("binary_candidates")
+            )
+            distance = candidates.c.embedding.op(self.distance_operator, return_type=Float)(query_vector)
+            return (
+                select(candidates.c.id, func.rank().over(order_by=distance).label("rank"))
+                .order_by(distance)
+                .limit(limit)
+            )
+
+        distance = self.embedding_distance(query_vector)
+        return (
+            select(Item.id, func.rank().over(order_by=distance).label("rank"))
+            .where(*filter_clauses)
+            .order_by(distance)
+            .limit(limit)
+        )
+
+    async def get_brands(self) -> list[str]:
+        """Return the distinct brands of the items, longest first so that the most specific names match first."""
+        if time.monotonic() >= self._brands_expire_at:
+            async with self.async_session_maker() as session:
+                brands = (await session.scalars(select(Item.brand).distinct())).all()
+            self._brands = sorted(brands, key=len, reverse=True)
+            self._brands_expire_at = time.monotonic() + self.brands_ttl_seconds
+        return self._brands
+
+    def build_filter_clauses(self, filters: list[dict] | None) -> list[ColumnElement[bool]]:
+        """Compile query rewriter filters into SQLAlchemy expressions with bound values.
+
+        Filters that use an unknown column or operator, or a value of the wrong type, are skipped.
+        """
         if filters is None:
-            return "", ""
+            return []
         filter_clauses = []
         for filter in filters:
-            if isinstance(filter["value"], str):
-                filter["value"] = f"'{filter['value']}'"
-            filter_clauses.append(f"{filter['column']} {filter['comparison_operator']} {filter['value']}")
-        filter_clause = " AND ".join(filter_clauses)
-        if len(filter_clause) > 0:
-            return f"WHERE {filter_clause}", f"AND {filter_clause}"
-        return "", ""
+            column_and_type = FILTER_COLUMNS.get(filter.get("column"))
+            comparison = FILTER_OPERATORS.get(filter.get("comparison_operator"))
+            if column_and_type is None or comparison is None:
+                logger.warning("Ignoring unsupported filter: %s", filter)
+                continue
+            column, value_type = column_and_type
+            try:
+                value = value_type(filter["value"])
+            except (KeyError, TypeError, ValueError):
+                logger.warning("Ignoring filter with invalid value: %s", filter)
+                continue
+            filter_clauses.append(comparison(column, value))
+        return filter_clauses
 
-    async def search(
+    def build_search_query(
         self,
         query_text: str | None,
         query_vector: list[float] | list,
         query_top: int = 5,
         filters: list[dict] | None = None,
-    ):
+        vector_candidates: int = 20,
+        text_candidates: int = 20,
+    ) -> Select:
+        """Build the query returning the ids of the top items for vector, full text or hybrid (RRF) ranking."""
 
-        filter_clause_where, filter_clause_and = self.build_filter_clause(filters)
-
-        vector_query = f"""
-            SELECT id, RANK () OVER (ORDER BY embedding <=> :embedding) AS rank
-                FROM items
-                {filter_clause_where}
-                ORDER BY embedding <=> :embedding
-                LIMIT 20
-            """
-
-        fulltext_query = f"""
-            SELECT id, RANK () OVER (ORDER BY ts_rank_cd(to_tsvector('english', description), query) DESC)
-                FROM items, plainto_tsquery('english', :query) query
-                WHERE to_tsvector('english', description) @@ query {filter_clause_and}
-                ORDER BY ts_rank_cd(to_tsvector('english', description), query) DESC
-                LIMIT 20
-            """
-
-        hybrid_query = f"""
-        WITH vector_search AS (
-            {vector_query}
-        ),
-        fulltext_search AS (
-            {fulltext_query}
+        filter_clauses = self.build_filter_clauses(filters)
+
+        tsquery = func.plainto_tsquery("english", query_text).column_valued("query")
+        text_rank = func.ts_rank_cd(Item.description_tsv, tsquery)
+        fulltext_query = (
+            select(Item.id, func.rank().over(order_by=text_rank.desc()).label("rank"))
+            .where(Item.description_tsv.op("@@")(tsquery), *filter_clauses)
+            .order_by(text_rank.desc())
         )
-        SELECT
-            COALESCE(vector_search.id, fulltext_search.id) AS id,
-            COALESCE(1.0 / (:k + vector_search.rank), 0.0) +
-            COALESCE(1.0 / (:k + fulltext_search.rank), 0.0) AS score
-        FROM vector_search
-        FULL OUTER JOIN fulltext_search ON vector_search.id = fulltext_search.id
-        ORDER BY score DESC
-        LIMIT 20
-        """
 
         if query_text is not None and len(query_vector) > 0:
-            sql = text(hybrid_query).columns(id=Integer, score=Float)
+            vector_query = self.build_vector_query(query_vector, filter_clauses, vector_candidates)
+            vector_search = vector_query.cte("vector_search")
+            fulltext_search = fulltext_query.limit(text_candidates).cte("fulltext_search")
+            k = 60
+            score = (
+                func.coalesce(literal(1.0) / (k + vector_search.c.rank), 0.0)
+                + func.coalesce(literal(1.0) / (k + fulltext_search.c.rank), 0.0)
+            ).label("score")
+            return (
+                select(func.coalesce(vector_search.c.id, fulltext_search.c.id).label("id"), score)
+                .select_from(
+                    vector_search.join(fulltext_search, vector_search.c.id == fulltext_search.c.id, full=True)
+                )
+                .order_by(score.desc())
+                .limit(query_top)
+            )
         elif len(query_vector) > 0:
-            sql = text(vector_query).columns(id=Integer, rank=Integer)
+            return self.build_vector_query(query_vector, filter_clauses, query_top)
         elif query_text is not None:
-            sql = text(fulltext_query).columns(id=Integer, rank=Integer)
+            return fulltext_query.limit(query_top)
         else:
             raise ValueError("Both query text and query vector are empty")
 
-        async with self.async_session_maker() as session:
-            results = (
+    def search_ef_search(
+        self,
+        ef_search: int | None,
+        query_text: str | None,
+        query_vector: list[float] | list,
+        query_top: int,
+        vector_candidates: int,
+    ) -> int | None:
+        """Return the hnsw.ef_search for a search, raised so that the index scan can return every row it needs.
+
+        That is the LIMIT of the vector leg, which the binary pass of the bit index multiplies by binary_oversampling.
+        """
+        if len(query_vector) == 0:
+            return ef_search
+        scan_limit = vector_candidates if query_text is not None else query_top
+        if self.embedding_index_type == "bit":
+            scan_limit *= self.binary_oversampling
+        scan_limit = min(scan_limit, HNSW_MAX_EF_SEARCH)
+        if scan_limit <= (ef_search or HNSW_DEFAULT_EF_SEARCH):
+            return ef_search
+        return scan_limit
+
+    async def set_ef_search(self, session: AsyncSession, ef_search: int | None, query_vector: list[float] | list):
+        if ef_search is not None and len(query_vector) > 0:
+            # is_local=true scopes the setting to this session's transaction
+            with SEARCH_QUERY_SECONDS.labels("set_ef_search").time():
                 await session.execute(
-                    sql,
-                    {"embedding": to_db(query_vector), "query": query_text, "k": 60},
+                    text("SELECT set_config('hnsw.ef_search', :ef_search, true)"), {"ef_search": str(ef_search)}
                 )
-            ).fetchall()
-
-            # Convert results to Item models
-            items = []
-            for id, _ in results[:query_top]:
-                item = await session.execute(select(Item).where(Item.id == id))
-                items.append(item.scalar())
-            return items
+
+    async def search(
+        self,
+        query_text: str | None,
+        query_vector: list[float] | list,
+        query_top: int = 5,
+        filters: list[dict] | None = None,
+        vector_candidates: int = 20,
+        text_candidates: int = 20,
+        ef_search: int | None = None,
+    ):
+        """Search items with vector, full text or hybrid (RRF) ranking.
+
+        query_top is the number of items returned. vector_candidates and text_candidates are how many rows each
+        leg of a hybrid search contributes to the fusion step; they are ignored when only one leg runs.
+        ef_search optionally sets hnsw.ef_search for this query only, to trade speed for recall. It is raised to the
+        number of rows the vector leg fetches from the index when that is larger, so that widening vector_candidates
+        (or, with the bit index, binary_oversampling) is not capped by the default ef_search of 40.
+        Identical searches that run concurrently in this worker share one query and its results.
+        """
+        key = (
+            query_text,
+            tuple(query_vector),
+            query_top,
+            json.dumps(filters, sort_keys=True),
+            vector_candidates,
+            text_candidates,
+            ef_search,
+        )
+        return await self.search_calls.run(
+            key,
+            self._search,
+            query_text,
+            query_vector,
+            query_top,
+            filters,
+            vector_candidates,
+            text_candidates,
+            ef_search,
+        )
+
+    async def _search(
+        self,
+        query_text: str | None,
+        query_vector: list[float] | list,
+        query_top: int,
+        filters: list[dict] | None,
+        vector_candidates: int,
+        text_candidates: int,
+        ef_search: int | None,
+    ) -> list[Item]:
+        sql = self.build_search_query(query_text, query_vector, query_top, filters, vector_candidates, text_candidates)
+        ef_search = self.search_ef_search(ef_search, query_text, query_vector, query_top, vector_candidates)
+
+        async with self.async_session_maker() as session:
+            await self.set_ef_search(session, ef_search, query_vector)
+            with SEARCH_QUERY_SECONDS.labels("rank").time():
+                results = (await session.execute(sql)).fetchall()
+
+            # Convert results to Item models in a single round-trip, preserving rank order
+            ids = [id for id, _ in results]
+            if not ids:
+                return []
+            with SEARCH_QUERY_SECONDS.labels("hydrate").time():
+                items = (await session.scalars(select(Item).where(Item.id.in_(ids)))).all()
+            items_by_id = {item.id: item for item in items}
+            return [items_by_id[id] for id in ids if id in items_by_id]
+
+    def should_explain(self, requested: bool = False) -> bool:
+        """Whether to explain this search: when the request asks for it, or for a sample of all searches."""
+        return requested or random.random() < self.explain_sample_rate
+
+    async def explain_search(
+        self,
+        query_text: str | None,
+        query_vector: list[float] | list,
+        query_top: int = 5,
+        filters: list[dict] | None = None,
+        vector_candidates: int = 20,
+        text_candidates: int = 20,
+        ef_search: int | None = None,
+    ) -> dict:
+        """Run the search query under EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) and summarize its plan.
+
+        EXPLAIN ANALYZE executes the query, so this costs about as much as the search itself.
+        Plans slower than explain_slow_ms are logged in full.
+        """
+        sql = self.build_search_query(query_text, query_vector, query_top, filters, vector_candidates, text_candidates)
+        ef_search = self.search_ef_search(ef_search, query_text, query_vector, query_top, vector_candidates)
+        async with self.async_session_maker() as session:
+            await self.set_ef_search(session, ef_search, query_vector)
+            plan = (await session.execute(Explain(sql))).scalar_one()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        summary = summarize_plan(plan[0])
+        if summary["execution_time_ms"] >= self.explain_slow_ms:
+            logger.warning("Slow search query (%.1f ms), plan: %s", summary["execution_time_ms"], json.dumps(plan))
+        return summary
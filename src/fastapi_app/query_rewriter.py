@@ -1,4 +1,5 @@
 import json
+import re
 
 from openai.types.chat import (
     ChatCompletion,
@@ -89,3 +90,95 @@ def extract_search_arguments(chat_completion: ChatCompletion):
     elif query_text := response_message.content:
         search_query = query_text.strip()
     return search_query, filters
+
+
+# Price phrases the rule-based rewriter understands, mapped to the comparison operator of the filter
+PRICE_COMPARISONS = {
+    "under": "<",
+    "below": "<",
+    "less than": "<",
+    "cheaper than": "<",
+    "up to": "<=",
+    "at most": "<=",
+    "no more than": "<=",
+    "over": ">",
+    "above": ">",
+    "more than": ">",
+    "at least": ">=",
+}
+# An amount with optional thousands separators, like 40, 1000, 1,000 or 1,299.99. It must not be followed by more
+# digits, so that "1,0000" isn't read as 1,000.
+AMOUNT = r"(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?(?!,?\d)"
+PRICE_PATTERN = re.compile(
+    r"\b(?P<comparison>" + "|".join(PRICE_COMPARISONS) + rf")\s+(?P<dollar>\$)?\s*(?P<value>{AMOUNT})"
+    r"(?:\s*(?P<currency>dollars|usd|bucks)\b)?",
+    re.IGNORECASE,
+)
+BETWEEN_PRICE_PATTERN = re.compile(
+    rf"\bbetween\s+\$\s*(?P<low>{AMOUNT})\s+and\s+\$\s*(?P<high>{AMOUNT})", re.IGNORECASE
+)
+BRAND_PREFIX = re.compile(
+    r"(?:\b(?P<negation>not|except|other than|excluding|no)\s+)?(?:\b(?:from|by|made by)\s+)?$", re.IGNORECASE
+)
+# Longer questions are more likely to need the model to pick out what to search for
+RULES_MAX_WORDS = 12
+
+
+def parse_amount(amount: str) -> float:
+    return float(amount.replace(",", ""))
+
+
+def extract_search_arguments_from_rules(query: str, brands: list[str]) -> tuple[str, list[dict]] | None:
+    """Extract the search query and filters from a short question without a chat completion.
+
+    Understands price phrases such as "under $50" or "between $20 and $40" and mentions of the given brands,
+    and returns filters with the same structure as extract_search_arguments. Returns None when the question is
+    ambiguous (too long, a number without a currency, several brands or prices), so the caller falls back to the LLM.
+    """
+    if len(query.split()) > RULES_MAX_WORDS:
+        return None
+
+    filters = []
+    remaining_query = query
+
+    price_matches = list(PRICE_PATTERN.finditer(query))
+    between_match = BETWEEN_PRICE_PATTERN.search(query)
+    if len(price_matches) + bool(between_match) > 1:
+        return None
+    if between_match:
+        filters.append({"column": "price", "comparison_operator": ">=", "value": parse_amount(between_match["low"])})
+        filters.append({"column": "price", "comparison_operator": "<=", "value": parse_amount(between_match["high"])})
+        remaining_query = remaining_query.replace(between_match[0], " ")
+    elif price_matches:
+        price_match = price_matches[0]
+        # "under 5" could be a size or a weight, so only prices marked as such are taken as price filters
+        if not (price_match["dollar"] or price_match["currency"]):
+            return None
+        filters.append(
+            {
+                "column": "price",
+                "comparison_operator": PRICE_COMPARISONS[price_match["comparison"].lower()],
+                "value": parse_amount(price_match["value"]),
+            }
+        )
+        remaining_query = remaining_query.replace(price_match[0], " ")
+    elif re.search(r"\$\s*\d", query):
+        return None
+
+    brand_matches = [
+        (brand, match)
+        for brand in brands
+        if (match := re.search(rf"(?<!\w){re.escape(brand)}(?!\w)", query, re.IGNORECASE))
+    ]
+    if len(brand_matches) > 1:
+        return None
+    if brand_matches:
+        brand, brand_match = brand_matches[0]
+        # Drop the words that introduce the brand, like "by" or "not from", along with the brand itself
+        prefix = BRAND_PREFIX.search(query, 0, brand_match.start())
+        comparison_operator = "!=" if prefix["negation"] else "=="
+        filters.append({"column": "brand", "comparison_operator": comparison_operator, "value": brand})
+        remaining_query = remaining_query.replace(query[prefix.start() : brand_match.end()], " ")
+
+    search_query = " ".join(remaining_query.strip(" ?!.,").split())
+    return (search_query or query), filters
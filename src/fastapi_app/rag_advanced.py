@@ -1,22 +1,26 @@
+import asyncio
 import pathlib
-from collections.abc import AsyncGenerator
 from typing import (
     Any,
 )
 
 from openai import AsyncOpenAI
 from openai.types.chat import (
-    ChatCompletion,
+    ChatCompletionMessageParam,
 )
 from openai_messages_token_helper import build_messages, get_token_limit
 
+from .answer_cache import AnswerCache
 from .api_models import ThoughtStep
-from .embeddings import compute_text_embedding
+from .embedding_cache import EmbeddingCache
+from .metrics import STAGE_SECONDS, record_token_usage
 from .postgres_searcher import PostgresSearcher
-from .query_rewriter import build_search_function, extract_search_arguments
+from .query_rewriter import build_search_function, extract_search_arguments, extract_search_arguments_from_rules
+from .rag_base import SEARCH_PLAN_TITLE, RAGChatBase
+from .search_arguments_cache import SearchArgumentsCache
 
 
-class AdvancedRAGChat:
+class AdvancedRAGChat(RAGChatBase):
 
     def __init__(
         self,
@@ -29,6 +33,9 @@ class AdvancedRAGChat:
         embed_deployment: str | None,  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embed_model: str,
         embed_dimensions: int,
+        embedding_cache: EmbeddingCache | None = None,
+        answer_cache: AnswerCache | None = None,
+        search_arguments_cache: SearchArgumentsCache | None = None,
     ):
         self.searcher = searcher
         self.openai_chat_client = openai_chat_client
@@ -38,14 +45,17 @@ class AdvancedRAGChat:
         self.embed_deployment = embed_deployment
         self.embed_model = embed_model
         self.embed_dimensions = embed_dimensions
+        self.embedding_cache = embedding_cache
+        self.answer_cache = answer_cache
+        self.search_arguments_cache = search_arguments_cache
         self.chat_token_limit = get_token_limit(chat_model, default_to_minimum=True)
         current_dir = pathlib.Path(__file__).parent
-        self.query_prompt_template = open(current_dir / "prompts/query.txt").read()
-        self.answer_prompt_template = open(current_dir / "prompts/answer.txt").read()
+        self.query_prompt_template = (current_dir / "prompts/query.txt").read_text()
+        self.answer_prompt_template = (current_dir / "prompts/answer.txt").read_text()
 
-    async def run(
-        self, messages: list[dict], overrides: dict[str, Any] = {}
-    ) -> dict[str, Any] | AsyncGenerator[dict[str, Any], None]:
+    async def prepare_context(
+        self, messages: list[dict], overrides: dict[str, Any], query_vector: list[float] | None = None
+    ) -> tuple[list[ChatCompletionMessageParam], dict[str, Any]]:
 
         text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -56,78 +66,112 @@ class AdvancedRAGChat:
 
         # Generate an optimized keyword search query based on the chat history and the last question
         query_response_token_limit = 500
-        query_messages = build_messages(
-            model=self.chat_model,
-            system_prompt=self.query_prompt_template,
-            new_user_content=original_user_query,
-            past_messages=past_messages,
-            max_tokens=self.chat_token_limit - query_response_token_limit,  # TODO: count functions
-            fallback_to_default=True,
-        )
-
-        chat_completion: ChatCompletion = await self.openai_chat_client.chat.completions.create(
-            messages=query_messages,  # type: ignore
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chat_deployment if self.chat_deployment else self.chat_model,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=query_response_token_limit,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            tools=build_search_function(),
-            tool_choice="auto",
-        )
-
-        query_text, filters = extract_search_arguments(chat_completion)
+        with STAGE_SECONDS.labels("build_messages").time():
+            query_messages = build_messages(
+                model=self.chat_model,
+                system_prompt=self.query_prompt_template,
+                new_user_content=original_user_query,
+                past_messages=past_messages,
+                max_tokens=self.chat_token_limit - query_response_token_limit,  # TODO: count functions
+                fallback_to_default=True,
+            )
 
-        # Retrieve relevant items from the database with the GPT optimized query
-        vector: list[float] = []
-        if vector_search:
-            vector = await compute_text_embedding(
-                original_user_query,
-                self.openai_embed_client,
-                self.embed_model,
-                self.embed_deployment,
-                self.embed_dimensions,
+        # The rule-based rewriter handles simple first questions without a chat completion, and returns None
+        # for anything it can't handle, which then goes to the model
+        rules_search_arguments = None
+        if overrides.get("query_rewriter") == "rules" and not past_messages:
+            rules_search_arguments = extract_search_arguments_from_rules(
+                original_user_query, await self.searcher.get_brands()
             )
+
+        async def generate_search_arguments() -> tuple[str | None, list[dict]]:
+            if rules_search_arguments is not None:
+                return rules_search_arguments
+
+            # The rewrite is deterministic (temperature 0), so reuse the arguments extracted for the same messages
+            if self.search_arguments_cache is not None:
+                cache_key = self.search_arguments_cache.make_key(query_messages, self.chat_model)
+                if (cached_arguments := await self.search_arguments_cache.get(cache_key)) is not None:
+                    return cached_arguments
+
+            with STAGE_SECONDS.labels("query_rewrite").time():
+                chat_completion = await self.openai_chat_client.chat.completions.create(
+                    messages=query_messages,  # type: ignore
+                    # Azure OpenAI takes the deployment name as the model name
+                    model=self.chat_deployment if self.chat_deployment else self.chat_model,
+                    temperature=0.0,  # Minimize creativity for search query generation
+                    max_tokens=query_response_token_limit,  # Setting too low risks malformed JSON, setting too high may affect performance
+                    n=1,
+                    tools=build_search_function(),
+                    tool_choice="auto",
+                )
+            if usage := chat_completion.usage:
+                record_token_usage(self.chat_model, "query_rewrite", usage.prompt_tokens, usage.completion_tokens)
+            search_arguments = extract_search_arguments(chat_completion)
+            if self.search_arguments_cache is not None:
+                await self.search_arguments_cache.set(cache_key, search_arguments)
+            return search_arguments
+
+        async def embed_user_query() -> list[float]:
+            if not vector_search:
+                return []
+            return query_vector or await self.compute_query_embedding(original_user_query)
+
+        # The embedding is computed from the original question, so it doesn't need to wait for the rewrite
+        tasks = [asyncio.create_task(generate_search_arguments()), asyncio.create_task(embed_user_query())]
+        try:
+            (query_text, filters), vector = await asyncio.gather(*tasks)
+        except BaseException:
+            # gather() leaves the other task running if one fails, so cancel it before propagating the error
+            for task in tasks:
+                task.cancel()
+            raise
+
+        # Retrieve relevant items from the database with the GPT optimized query
         if not text_search:
             query_text = None
 
-        results = await self.searcher.search(query_text, vector, top, filters)
+        # Opt-in diagnostics: explain the search query plan when requested or sampled
+        search_plan = None
+        if self.searcher.should_explain(overrides.get("explain_search", False)):
+            search_plan = await self.searcher.explain_search(query_text, vector, top, filters)
+
+        with STAGE_SECONDS.labels("search").time():
+            results = await self.searcher.search(query_text, vector, top, filters)
 
         sources_content = [f"[{(item.id)}]:{item.to_str_for_rag()}\n\n" for item in results]
         content = "\n".join(sources_content)
 
         # Generate a contextual and content specific answer using the search results and chat history
-        response_token_limit = 1024
-        messages = build_messages(
-            model=self.chat_model,
-            system_prompt=overrides.get("prompt_template") or self.answer_prompt_template,
-            new_user_content=original_user_query + "\n\nSources:\n" + content,
-            past_messages=past_messages,
-            max_tokens=self.chat_token_limit - response_token_limit,
-            fallback_to_default=True,
-        )
-
-        chat_completion_response = await self.openai_chat_client.chat.completions.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chat_deployment if self.chat_deployment else self.chat_model,
-            messages=messages,
-            temperature=overrides.get("temperature", 0.3),
-            max_tokens=response_token_limit,
-            n=1,
-            stream=False,
-        )
-        chat_resp = chat_completion_response.model_dump()
-        chat_resp["choices"][0]["context"] = {
+        with STAGE_SECONDS.labels("build_messages").time():
+            contextual_messages = build_messages(
+                model=self.chat_model,
+                system_prompt=overrides.get("prompt_template") or self.answer_prompt_template,
+                new_user_content=original_user_query + "\n\nSources:\n" + content,
+                past_messages=past_messages,
+                max_tokens=self.chat_token_limit - self.response_token_limit,
+                fallback_to_default=True,
+            )
+
+        context = {
             "data_points": {"text": sources_content},
             "thoughts": [
-                ThoughtStep(
-                    title="Prompt to generate search arguments",
-                    description=[str(message) for message in query_messages],
-                    props=(
-                        {"model": self.chat_model, "deployment": self.chat_deployment}
-                        if self.chat_deployment
-                        else {"model": self.chat_model}
-                    ),
+                (
+                    ThoughtStep(
+                        title="Search arguments from rules",
+                        description=original_user_query,
+                        props={"query_rewriter": "rules"},
+                    )
+                    if rules_search_arguments is not None
+                    else ThoughtStep(
+                        title="Prompt to generate search arguments",
+                        description=[str(message) for message in query_messages],
+                        props=(
+                            {"model": self.chat_model, "deployment": self.chat_deployment}
+                            if self.chat_deployment
+                            else {"model": self.chat_model}
+                        ),
+                    )
                 ),
                 ThoughtStep(
                     title="Search using generated search arguments",
@@ -143,9 +187,14 @@ class AdvancedRAGChat:
                     title="Search results",
                     description=[result.to_dict() for result in results],
                 ),
+                *(
+                    [ThoughtStep(title=SEARCH_PLAN_TITLE, description=search_plan)]
+                    if search_plan is not None
+                    else []
+                ),
                 ThoughtStep(
                     title="Prompt to generate answer",
-                    description=[str(message) for message in messages],
+                    description=[str(message) for message in contextual_messages],
                     props=(
                         {"model": self.chat_model, "deployment": self.chat_deployment}
                         if self.chat_deployment
@@ -154,4 +203,4 @@ class AdvancedRAGChat:
                 ),
             ],
         }
-        return chat_resp
+        return contextual_messages, context
@@ -0,0 +1,205 @@
+import time
+from abc import ABC, abstractmethod
+from collections.abc import AsyncGenerator
+from typing import (
+    Any,
+)
+
+from fastapi.encoders import jsonable_encoder
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletionMessageParam
+from openai_messages_token_helper import count_tokens_for_message
+
+from .answer_cache import AnswerCache, CachedAnswer
+from .embedding_cache import EmbeddingCache
+from .embeddings import compute_text_embedding
+from .metrics import IN_FLIGHT_REQUESTS, STAGE_SECONDS, record_token_usage
+
+# Title of the thought step with the summary of an explained search
+SEARCH_PLAN_TITLE = "Search query plan"
+
+
+class RAGChatBase(ABC):
+    openai_chat_client: AsyncOpenAI
+    chat_model: str
+    chat_deployment: str | None
+    openai_embed_client: AsyncOpenAI
+    embed_deployment: str | None
+    embed_model: str
+    embed_dimensions: int
+    embedding_cache: EmbeddingCache | None = None
+    answer_cache: AnswerCache | None = None
+    response_token_limit = 1024
+
+    @abstractmethod
+    async def prepare_context(
+        self, messages: list[dict], overrides: dict[str, Any], query_vector: list[float] | None = None
+    ) -> tuple[list[ChatCompletionMessageParam], dict[str, Any]]:
+        """Retrieve sources for the last question and build the answer prompt.
+
+        query_vector is the embedding of the last question, if it was already computed for the answer cache.
+        Returns the messages to send to the chat model and the context (data points and thoughts) for the response.
+        """
+
+    async def compute_query_embedding(self, query: str) -> list[float]:
+        with STAGE_SECONDS.labels("embedding").time():
+            return await compute_text_embedding(
+                query,
+                self.openai_embed_client,
+                self.embed_model,
+                self.embed_deployment,
+                self.embed_dimensions,
+                cache=self.embedding_cache,
+            )
+
+    async def get_cached_answer(
+        self, messages: list[dict], overrides: dict[str, Any]
+    ) -> tuple[CachedAnswer | None, list[float] | None, str | None]:
+        """Look up an answer to a single-turn question in the answer cache.
+
+        Returns the cached answer, if any, and the question embedding and scope to store a new answer with.
+        Follow-up questions depend on the conversation so far, and diagnostic requests need a fresh search,
+        so they are neither looked up nor stored. Neither are text-only searches, which don't otherwise need
+        the question embedding.
+        """
+        if (
+            self.answer_cache is None
+            or len(messages) != 1
+            or overrides.get("explain_search")
+            or overrides.get("retrieval_mode") == "text"
+        ):
+            return None, None, None
+        embedding = await self.compute_query_embedding(messages[-1]["content"])
+        scope = self.answer_cache.make_scope(
+            flow=type(self).__name__,
+            chat_model=self.chat_model,
+            embed_model=self.embed_model,
+            embed_dimensions=self.embed_dimensions,
+            overrides=overrides,
+        )
+        return await self.answer_cache.get(embedding, scope), embedding, scope
+
+    async def set_cached_answer(
+        self, embedding: list[float] | None, scope: str | None, answer: str, context: dict[str, Any]
+    ):
+        if self.answer_cache is None or embedding is None or scope is None:
+            return
+        # A plan from a sampled explain describes that one search, so it must not be replayed to later questions
+        if any(thought.title == SEARCH_PLAN_TITLE for thought in context["thoughts"]):
+            return
+        await self.answer_cache.set(embedding, scope, answer, jsonable_encoder(context))
+
+    async def run(self, messages: list[dict], overrides: dict[str, Any] = {}) -> dict[str, Any]:
+        with IN_FLIGHT_REQUESTS.labels("non_streaming").track_inprogress():
+            cached_answer, cache_embedding, cache_scope = await self.get_cached_answer(messages, overrides)
+            if cached_answer is not None:
+                return {
+                    "object": "chat.completion",
+                    "model": self.chat_model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": cached_answer.answer},
+                            "finish_reason": "stop",
+                            "context": {**cached_answer.context, "cache_hit": True},
+                        }
+                    ],
+                }
+
+            contextual_messages, context = await self.prepare_context(messages, overrides, cache_embedding)
+            context["cache_hit"] = False
+
+            with STAGE_SECONDS.labels("answer_generation").time():
+                chat_completion_response = await self.openai_chat_client.chat.completions.create(
+                    # Azure OpenAI takes the deployment name as the model name
+                    model=self.chat_deployment if self.chat_deployment else self.chat_model,
+                    messages=contextual_messages,
+                    temperature=overrides.get("temperature", 0.3),
+                    max_tokens=self.response_token_limit,
+                    n=1,
+                    stream=False,
+                )
+            if usage := chat_completion_response.usage:
+                record_token_usage(self.chat_model, "answer", usage.prompt_tokens, usage.completion_tokens)
+            chat_resp = chat_completion_response.model_dump()
+            chat_resp["choices"][0]["context"] = context
+            # Only complete answers are worth reusing, not those cut off by the token limit or a content filter
+            if chat_resp["choices"][0]["finish_reason"] == "stop":
+                await self.set_cached_answer(
+                    cache_embedding, cache_scope, chat_resp["choices"][0]["message"]["content"], context
+                )
+            return chat_resp
+
+    async def run_stream(
+        self, messages: list[dict], overrides: dict[str, Any] = {}
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        with IN_FLIGHT_REQUESTS.labels("streaming").track_inprogress():
+            cached_answer, cache_embedding, cache_scope = await self.get_cached_answer(messages, overrides)
+            if cached_answer is not None:
+                yield {
+                    "object": "chat.completion.chunk",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {"role": "assistant"},
+                            "context": {**cached_answer.context, "cache_hit": True},
+                            "finish_reason": None,
+                        }
+                    ],
+                }
+                yield {
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": cached_answer.answer}, "finish_reason": "stop"}],
+                }
+                return
+
+            contextual_messages, context = await self.prepare_context(messages, overrides, cache_embedding)
+            context["cache_hit"] = False
+
+            # Send the sources and thoughts first so the client can show them while the answer is generated
+            yield {
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"role": "assistant"}, "context": context, "finish_reason": None}],
+            }
+
+            answer_parts = []
+            finish_reason = None
+            # Only the waits for the chat model count as answer generation, not the client reading each chunk
+            start_time = time.perf_counter()
+            chat_completion_stream = await self.openai_chat_client.chat.completions.create(
+                # Azure OpenAI takes the deployment name as the model name
+                model=self.chat_deployment if self.chat_deployment else self.chat_model,
+                messages=contextual_messages,
+                temperature=overrides.get("temperature", 0.3),
+                max_tokens=self.response_token_limit,
+                n=1,
+                stream=True,
+            )
+            generation_seconds = time.perf_counter() - start_time
+            chunks = aiter(chat_completion_stream)
+            while True:
+                start_time = time.perf_counter()
+                try:
+                    chunk = await anext(chunks)
+                except StopAsyncIteration:
+                    break
+                finally:
+                    generation_seconds += time.perf_counter() - start_time
+                # Azure OpenAI sends an initial chunk with only content filter results and no choices
+                if chunk.choices:
+                    answer_parts.append(chunk.choices[0].delta.content or "")
+                    finish_reason = chunk.choices[0].finish_reason or finish_reason
+                    yield chunk.model_dump()
+            STAGE_SECONDS.labels("answer_generation").observe(generation_seconds)
+            # Streamed responses don't report usage, so count the prompt and take each content chunk as one token
+            record_token_usage(
+                self.chat_model,
+                "answer",
+                sum(
+                    count_tokens_for_message(self.chat_model, message, default_to_cl100k=True)
+                    for message in contextual_messages
+                ),
+                sum(1 for part in answer_parts if part),
+            )
+            if finish_reason == "stop":
+                await self.set_cached_answer(cache_embedding, cache_scope, "".join(answer_parts), context)
@@ -1,18 +1,21 @@
 import pathlib
-from collections.abc import AsyncGenerator
 from typing import (
     Any,
 )
 
 from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletionMessageParam
 from openai_messages_token_helper import build_messages, get_token_limit
 
+from .answer_cache import AnswerCache
 from .api_models import ThoughtStep
-from .embeddings import compute_text_embedding
+from .embedding_cache import EmbeddingCache
+from .metrics import STAGE_SECONDS
 from .postgres_searcher import PostgresSearcher
+from .rag_base import SEARCH_PLAN_TITLE, RAGChatBase
 
 
-class SimpleRAGChat:
+class SimpleRAGChat(RAGChatBase):
 
     def __init__(
         self,
@@ -25,6 +28,8 @@ class SimpleRAGChat:
         embed_deployment: str | None,  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embed_model: str,
         embed_dimensions: int,
+        embedding_cache: EmbeddingCache | None = None,
+        answer_cache: AnswerCache | None = None,
     ):
         self.searcher = searcher
         self.openai_chat_client = openai_chat_client
@@ -34,13 +39,15 @@ class SimpleRAGChat:
         self.embed_deployment = embed_deployment
         self.embed_model = embed_model
         self.embed_dimensions = embed_dimensions
+        self.embedding_cache = embedding_cache
+        self.answer_cache = answer_cache
         self.chat_token_limit = get_token_limit(chat_model, default_to_minimum=True)
         current_dir = pathlib.Path(__file__).parent
-        self.answer_prompt_template = open(current_dir / "prompts/answer.txt").read()
+        self.answer_prompt_template = (current_dir / "prompts/answer.txt").read_text()
 
-    async def run(
-        self, messages: list[dict], overrides: dict[str, Any] = {}
-    ) -> dict[str, Any] | AsyncGenerator[dict[str, Any], None]:
+    async def prepare_context(
+        self, messages: list[dict], overrides: dict[str, Any], query_vector: list[float] | None = None
+    ) -> tuple[list[ChatCompletionMessageParam], dict[str, Any]]:
 
         text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -53,43 +60,33 @@ class SimpleRAGChat:
         vector: list[float] = []
         query_text = None
         if vector_search:
-            vector = await compute_text_embedding(
-                original_user_query,
-                self.openai_embed_client,
-                self.embed_model,
-                self.embed_deployment,
-                self.embed_dimensions,
-            )
+            vector = query_vector or await self.compute_query_embedding(original_user_query)
         if text_search:
             query_text = original_user_query
 
-        results = await self.searcher.search(query_text, vector, top)
+        # Opt-in diagnostics: explain the search query plan when requested or sampled
+        search_plan = None
+        if self.searcher.should_explain(overrides.get("explain_search", False)):
+            search_plan = await self.searcher.explain_search(query_text, vector, top)
+
+        with STAGE_SECONDS.labels("search").time():
+            results = await self.searcher.search(query_text, vector, top)
 
         sources_content = [f"[{(item.id)}]:{item.to_str_for_rag()}\n\n" for item in results]
         content = "\n".join(sources_content)
 
         # Generate a contextual and content specific answer using the search results and chat history
-        response_token_limit = 1024
-        messages = build_messages(
-            model=self.chat_model,
-            system_prompt=overrides.get("prompt_template") or self.answer_prompt_template,
-            new_user_content=original_user_query + "\n\nSources:\n" + content,
-            past_messages=past_messages,
-            max_tokens=self.chat_token_limit - response_token_limit,
-            fallback_to_default=True,
-        )
+        with STAGE_SECONDS.labels("build_messages").time():
+            contextual_messages = build_messages(
+                model=self.chat_model,
+                system_prompt=overrides.get("prompt_template") or self.answer_prompt_template,
+                new_user_content=original_user_query + "\n\nSources:\n" + content,
+                past_messages=past_messages,
+                max_tokens=self.chat_token_limit - self.response_token_limit,
+                fallback_to_default=True,
+            )
 
-        chat_completion_response = await self.openai_chat_client.chat.completions.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chat_deployment if self.chat_deployment else self.chat_model,
-            messages=messages,
-            temperature=overrides.get("temperature", 0.3),
-            max_tokens=response_token_limit,
-            n=1,
-            stream=False,
-        )
-        chat_resp = chat_completion_response.model_dump()
-        chat_resp["choices"][0]["context"] = {
+        context = {
             "data_points": {"text": sources_content},
             "thoughts": [
                 ThoughtStep(
@@ -105,9 +102,14 @@ class SimpleRAGChat:
                     title="Search results",
                     description=[result.to_dict() for result in results],
                 ),
+                *(
+                    [ThoughtStep(title=SEARCH_PLAN_TITLE, description=search_plan)]
+                    if search_plan is not None
+                    else []
+                ),
                 ThoughtStep(
                     title="Prompt to generate answer",
-                    description=[str(message) for message in messages],
+                    description=[str(message) for message in contextual_messages],
                     props=(
                         {"model": self.chat_model, "deployment": self.chat_deployment}
                         if self.chat_deployment
@@ -116,4 +118,4 @@ class SimpleRAGChat:
                 ),
             ],
         }
-        return chat_resp
+        return contextual_messages, context
@@ -0,0 +1,34 @@
+import hashlib
+import json
+
+from sqlalchemy import Row
+
+from .postgres_models import SearchArgumentsCacheEntry
+from .two_tier_cache import TwoTierCache
+
+SearchArguments = tuple[str | None, list[dict]]
+
+
+class SearchArgumentsCache(TwoTierCache[SearchArguments]):
+    """Cache of the search query and filters extracted from query rewrites, keyed on the rewrite prompt.
+
+    The rewrite runs with temperature 0, so the same messages give the same search arguments.
+    """
+
+    name = "search_arguments"
+    entry_model = SearchArgumentsCacheEntry
+
+    @staticmethod
+    def make_key(query_messages: list, chat_model: str) -> str:
+        serialized_messages = json.dumps(query_messages, sort_keys=True, default=str)
+        return hashlib.sha256(f"{chat_model}\0{serialized_messages}".encode()).hexdigest()
+
+    def value_columns(self) -> list:
+        return [SearchArgumentsCacheEntry.query_text, SearchArgumentsCacheEntry.filters]
+
+    def value_from_row(self, row: Row) -> SearchArguments:
+        return row.query_text, row.filters
+
+    def value_to_columns(self, search_arguments: SearchArguments) -> dict:
+        query_text, filters = search_arguments
+        return {"query_text": query_text, "filters": filters}
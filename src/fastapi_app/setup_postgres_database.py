@@ -1,22 +1,128 @@
 import argparse
 import asyncio
 import logging
+import os
 
 from dotenv import load_dotenv
 from sqlalchemy import text
 
+from fastapi_app.openai_clients import get_openai_embed_dimensions
 from fastapi_app.postgres_engine import create_postgres_engine_from_args, create_postgres_engine_from_env
-from fastapi_app.postgres_models import Base
+from fastapi_app.postgres_models import (
+    EMBEDDING_DISTANCE_METRICS,
+    EMBEDDING_INDEX_NAMES,
+    LEGACY_EMBEDDING_INDEX_NAMES,
+    Base,
+    create_embedding_index_sql,
+    embedding_index_opclass,
+    get_embedding_column_dimensions,
+    get_embedding_index_opclass,
+    set_embedding_dimensions,
+)
 
 logger = logging.getLogger("ragapp")
 
 
-async def create_db_schema(engine):
+async def create_db_schema(
+    engine,
+    embed_dimensions: int = 1536,
+    reset_embeddings: bool = False,
+    embedding_index_type: str = "vector",
+    embedding_distance_metric: str = "cosine",
+):
+    set_embedding_dimensions(embed_dimensions)
     async with engine.begin() as conn:
         logger.info("Enabling the pgvector extension for Postgres...")
         await conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
         logger.info("Creating database tables and indexes...")
         await conn.run_sync(Base.metadata.create_all)
+        # create_all() skips tables that already exist, so add newer columns and indexes to older tables
+        logger.info("Ensuring the full text search and embedding hash columns exist...")
+        await conn.execute(
+            text(
+                "ALTER TABLE items ADD COLUMN IF NOT EXISTS description_tsv tsvector "
+                "GENERATED ALWAYS AS (to_tsvector('english', description)) STORED"
+            )
+        )
+        await conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS gin_index_for_item_description_tsv ON items USING gin (description_tsv)"
+            )
+        )
+        await conn.execute(
+            text(
+                "ALTER TABLE items ADD COLUMN IF NOT EXISTS embedding_hash varchar, "
+                "ADD COLUMN IF NOT EXISTS embedding_model varchar, "
+                "ADD COLUMN IF NOT EXISTS embedding_dimensions integer"
+            )
+        )
+        await conn.execute(text("ALTER TABLE items ALTER COLUMN embedding DROP NOT NULL"))
+
+        # Cached answers may be based on outdated items, so any change to items empties the answer cache
+        logger.info("Creating the trigger that invalidates the answer cache...")
+        await conn.execute(
+            text(
+                "CREATE OR REPLACE FUNCTION clear_answer_cache() RETURNS trigger LANGUAGE plpgsql AS "
+                "$$ BEGIN DELETE FROM answer_cache; RETURN NULL; END $$"
+            )
+        )
+        await conn.execute(
+            text(
+                "CREATE OR REPLACE TRIGGER clear_answer_cache_on_items_change "
+                "AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON items "
+                "FOR EACH STATEMENT EXECUTE FUNCTION clear_answer_cache()"
+            )
+        )
+
+        current_dimensions = await get_embedding_column_dimensions(conn)
+        if current_dimensions != embed_dimensions:
+            if not reset_embeddings:
+                raise ValueError(
+                    f"items.embedding has {current_dimensions} dimensions but {embed_dimensions} are configured. "
+                    "Run again with --reset-embeddings to clear the embeddings and resize the column, "
+                    "then run update_embeddings.py."
+                )
+            logger.info("Resizing items.embedding to %d dimensions and clearing embeddings...", embed_dimensions)
+            for index_name in [*EMBEDDING_INDEX_NAMES.values(), *LEGACY_EMBEDDING_INDEX_NAMES]:
+                await conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+            await conn.execute(
+                text(f"ALTER TABLE items ALTER COLUMN embedding TYPE vector({embed_dimensions}) USING NULL")
+            )
+            await conn.execute(text("UPDATE items SET embedding_hash = NULL, embedding_model = NULL"))
+
+        # Cached answers can be dropped rather than kept, since they are only reused for a while anyway
+        current_dimensions = await get_embedding_column_dimensions(conn, "answer_cache")
+        if current_dimensions != embed_dimensions:
+            logger.info("Resizing answer_cache.embedding to %d dimensions and clearing the cache...", embed_dimensions)
+            await conn.execute(text("DROP INDEX IF EXISTS hnsw_index_for_answer_cache_embedding"))
+            await conn.execute(text("DELETE FROM answer_cache"))
+            await conn.execute(text(f"ALTER TABLE answer_cache ALTER COLUMN embedding TYPE vector({embed_dimensions})"))
+        logger.info("Creating the HNSW index on answer cache embeddings for cosine distance...")
+        await conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS hnsw_index_for_answer_cache_embedding "
+                "ON answer_cache USING hnsw (embedding vector_cosine_ops)"
+            )
+        )
+
+        current_opclass = await get_embedding_index_opclass(conn, embedding_index_type)
+        if current_opclass not in (None, embedding_index_opclass(embedding_index_type, embedding_distance_metric)):
+            logger.info("Dropping the %s HNSW index built with %s...", embedding_index_type, current_opclass)
+            await conn.execute(text(f"DROP INDEX {EMBEDDING_INDEX_NAMES[embedding_index_type]}"))
+        logger.info(
+            "Creating the %s HNSW index on item embeddings for %s distance...",
+            embedding_index_type,
+            embedding_distance_metric,
+        )
+        await conn.execute(
+            text(create_embedding_index_sql(embedding_index_type, embed_dimensions, embedding_distance_metric))
+        )
+        # Only the index that the searcher uses is worth its memory, so drop indexes of other types
+        for index_type, index_name in EMBEDDING_INDEX_NAMES.items():
+            if index_type != embedding_index_type:
+                await conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+        for index_name in LEGACY_EMBEDDING_INDEX_NAMES:
+            await conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
 
     await conn.close()
 
@@ -29,6 +135,26 @@ async def main():
     parser.add_argument("--password", type=str, help="Postgres password")
     parser.add_argument("--database", type=str, help="Postgres database")
     parser.add_argument("--sslmode", type=str, help="Postgres sslmode")
+    parser.add_argument(
+        "--embed-dimensions", type=int, help="Embedding dimensions", default=get_openai_embed_dimensions()
+    )
+    parser.add_argument(
+        "--reset-embeddings", action="store_true", help="Clear existing embeddings if the dimensions changed"
+    )
+    parser.add_argument(
+        "--embedding-index-type",
+        type=str,
+        choices=list(EMBEDDING_INDEX_NAMES),
+        help="Precision of the HNSW index on item embeddings",
+        default=os.getenv("EMBEDDING_INDEX_TYPE", "vector"),
+    )
+    parser.add_argument(
+        "--embedding-distance-metric",
+        type=str,
+        choices=list(EMBEDDING_DISTANCE_METRICS),
+        help="Distance metric of the HNSW index, which must match the one the app searches with",
+        default=os.getenv("EMBEDDING_DISTANCE_METRIC", "cosine"),
+    )
 
     # if no args are specified, use environment variables
     args = parser.parse_args()
@@ -37,7 +163,13 @@ async def main():
     else:
         engine = await create_postgres_engine_from_args(args)
 
-    await create_db_schema(engine)
+    await create_db_schema(
+        engine,
+        args.embed_dimensions,
+        args.reset_embeddings,
+        args.embedding_index_type,
+        args.embedding_distance_metric,
+    )
 
     await engine.dispose()
 
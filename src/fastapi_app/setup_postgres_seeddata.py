@@ -1,21 +1,118 @@
 import argparse
 import asyncio
+import itertools
 import json
 import logging
 import os
+import re
+from collections.abc import Iterable, Iterator
 
-import sqlalchemy.exc
 from dotenv import load_dotenv
-from sqlalchemy import select, text
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from pgvector.asyncpg import register_vector
+from sqlalchemy import text
 
 from fastapi_app.postgres_engine import create_postgres_engine_from_args, create_postgres_engine_from_env
-from fastapi_app.postgres_models import Item
+from fastapi_app.postgres_models import get_embedding_column_dimensions
 
 logger = logging.getLogger("ragapp")
 
+ITEM_COLUMNS = ["id", "type", "brand", "name", "description", "price", "embedding"]
+STAGING_TABLE = "items_staging"
+# Whitespace and the comma between items of a JSON array
+ITEM_SEPARATOR = re.compile(r"\s*,?\s*")
+DEFAULT_SEED_DATA_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "seed_data.json")
+
+
+def read_catalog_items(path: str, chunk_size: int = 1 << 16) -> Iterator[dict]:
+    """Yield catalog items one at a time from a JSON array or an NDJSON (one object per line) file.
+
+    Only the current item and one read chunk are held in memory, however large the file is.
+    """
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        first_char = f.read(1)
+        while first_char.isspace():
+            first_char = f.read(1)
+        if first_char != "[":
+            # NDJSON: one item per line
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        buffer = ""
+        pos = 0
+        read_size = chunk_size
+        at_eof = False
+        while True:
+            pos = ITEM_SEPARATOR.match(buffer, pos).end()
+            if buffer.startswith("]", pos):
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The item is split across chunks, so read more and try again. Doubling the read size
+                # for each retry keeps decoding an item linear in its size, however many chunks it spans.
+                if at_eof:
+                    raise
+                more = f.read(read_size)
+                at_eof = not more
+                buffer = buffer[pos:] + more
+                pos = 0
+                read_size *= 2
+                continue
+            read_size = chunk_size
+            yield item
+
+
+def batched(iterable: Iterable, batch_size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+
+async def copy_items(engine, record_batches: Iterable[list[tuple]]) -> int:
+    """Bulk load batches of item records with COPY into a staging table, merging each batch into items.
+
+    Records are (id, type, brand, name, description, price, embedding) tuples. Each batch is committed on its own.
+    Items whose id already exists are left unchanged. Returns the number of inserted items.
+    """
+    inserted_count = 0
+    async with engine.connect() as conn:
+        asyncpg_connection = (await conn.get_raw_connection()).driver_connection
+        try:
+            # COPY sends vectors in binary format, which needs pgvector's codec on this connection
+            await register_vector(asyncpg_connection)
+            await asyncpg_connection.execute(
+                f"CREATE TEMPORARY TABLE {STAGING_TABLE} "
+                "(id integer, type text, brand text, name text, description text, price float8, embedding vector) "
+                "ON COMMIT DELETE ROWS"
+            )
+            for records in record_batches:
+                async with asyncpg_connection.transaction():
+                    await asyncpg_connection.copy_records_to_table(
+                        STAGING_TABLE, records=records, columns=ITEM_COLUMNS
+                    )
+                    status = await asyncpg_connection.execute(
+                        f"INSERT INTO items ({', '.join(ITEM_COLUMNS)}) "
+                        f"SELECT {', '.join(ITEM_COLUMNS)} FROM {STAGING_TABLE} "
+                        "ON CONFLICT (id) DO NOTHING"
+                    )
+                # The status of an INSERT is "INSERT 0 <row count>"
+                inserted_count += int(status.split()[-1])
+                logger.info("Inserted %d new items so far...", inserted_count)
+            # Explicit ids don't advance the serial sequence, so move it past the loaded ids
+            await asyncpg_connection.execute(
+                "SELECT setval(pg_get_serial_sequence('items', 'id'), GREATEST(MAX(id), 1)) FROM items"
+            )
+        finally:
+            # Don't return a connection with a non-default vector codec and a temporary table to the pool
+            await conn.invalidate()
+    return inserted_count
 
-async def seed_data(engine):
+
+async def seed_data(engine, path: str = DEFAULT_SEED_DATA_PATH, batch_size: int = 500):
 
     # Check if Item table exists
     async with engine.begin() as conn:
@@ -27,31 +124,37 @@ async def seed_data(engine):
         if not result.scalar():
             logger.error("Items table does not exist. Please run the database setup script first.")
             return
-
-    async with async_sessionmaker(engine, expire_on_commit=False)() as session:
-
-        # Insert the items from the JSON file into the database
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-        with open(os.path.join(current_dir, "seed_data.json")) as f:
-            catalog_items = json.load(f)
-            for catalog_item in catalog_items:
-                item = await session.execute(select(Item).filter(Item.id == catalog_item["Id"]))
-                if item.scalars().first():
-                    continue
-                item = Item(
-                    id=catalog_item["Id"],
-                    type=catalog_item["Type"],
-                    brand=catalog_item["Brand"],
-                    name=catalog_item["Name"],
-                    description=catalog_item["Description"],
-                    price=catalog_item["Price"],
-                    embedding=catalog_item["Embedding"],
-                )
-                session.add(item)
-            try:
-                await session.commit()
-            except sqlalchemy.exc.IntegrityError:
-                pass
+        embed_dimensions = await get_embedding_column_dimensions(conn)
+
+    def matching_embedding(embedding: list[float] | None) -> list[float] | None:
+        # Embeddings of another width can't be stored, so those items are loaded without one
+        if embedding is not None and len(embedding) != embed_dimensions:
+            return None
+        return embedding
+
+    # Insert the items from the JSON or NDJSON file into the database, batch_size items at a time
+    records = (
+        (
+            catalog_item["Id"],
+            catalog_item["Type"],
+            catalog_item["Brand"],
+            catalog_item["Name"],
+            catalog_item["Description"],
+            catalog_item["Price"],
+            matching_embedding(catalog_item.get("Embedding")),
+        )
+        for catalog_item in read_catalog_items(path)
+    )
+    inserted_count = await copy_items(engine, batched(records, batch_size))
+    logger.info("Inserted %d new items.", inserted_count)
+    async with engine.connect() as conn:
+        missing_count = await conn.scalar(text("SELECT COUNT(*) FROM items WHERE embedding IS NULL"))
+    if missing_count:
+        logger.warning(
+            "%d items have no embedding with %d dimensions. Run update_embeddings.py --only-stale to compute them.",
+            missing_count,
+            embed_dimensions,
+        )
 
     logger.info("Items table seeded successfully.")
 
@@ -64,6 +167,8 @@ async def main():
     parser.add_argument("--password", type=str, help="Postgres password")
     parser.add_argument("--database", type=str, help="Postgres database")
     parser.add_argument("--sslmode", type=str, help="Postgres sslmode")
+    parser.add_argument("--file", type=str, help="JSON array or NDJSON file of items", default=DEFAULT_SEED_DATA_PATH)
+    parser.add_argument("--batch-size", type=int, help="Number of items to load per COPY", default=500)
 
     # if no args are specified, use environment variables
     args = parser.parse_args()
@@ -72,7 +177,7 @@ async def main():
     else:
         engine = await create_postgres_engine_from_args(args)
 
-    await seed_data(engine)
+    await seed_data(engine, args.file, args.batch_size)
 
     await engine.dispose()
 
@@ -0,0 +1,32 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into a single call whose result (or exception) they all share.
+
+    Only calls that are in flight at the same time are coalesced, nothing is cached once a call completes.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Task] = {}
+
+    async def run(self, key: Hashable, function: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(function(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda done_task: self._forget(key, done_task))
+        # Shield the shared call, so that one caller being cancelled doesn't cancel it for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved, in case every caller was cancelled before the call failed
+        if not task.cancelled():
+            task.exception()
+
+    def __len__(self) -> int:
+        return len(self._calls)
@@ -0,0 +1,109 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Generic, TypeVar
+
+from sqlalchemy import Row, delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+from .metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger("ragapp")
+
+V = TypeVar("V")
+
+
+class TwoTierCache(ABC, Generic[V]):
+    """Cache with an in-memory LRU and TTL per worker, and an optional table shared by all workers.
+
+    Subclasses set the name used in logs and metrics, the model of the shared table (with key and created_at
+    columns), and how a value maps to and from the model's other columns.
+    """
+
+    name: str
+    entry_model: type
+
+    def __init__(self, *, max_size: int = 1000, ttl_seconds: int = 3600, engine: AsyncEngine | None = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.async_session_maker = async_sessionmaker(engine, expire_on_commit=False) if engine else None
+        self._entries: OrderedDict[str, tuple[float, V]] = OrderedDict()
+
+    @abstractmethod
+    def value_columns(self) -> list:
+        """The columns of entry_model that hold the value."""
+
+    @abstractmethod
+    def value_from_row(self, row: Row) -> V:
+        """Build a value from a row of the value columns."""
+
+    @abstractmethod
+    def value_to_columns(self, value: V) -> dict[str, Any]:
+        """Map a value to the values of its columns, by column name."""
+
+    async def get(self, key: str) -> V | None:
+        if entry := self._entries.get(key):
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                CACHE_LOOKUPS.labels(self.name, "local").inc()
+                return value
+            del self._entries[key]
+
+        if self.async_session_maker is not None:
+            try:
+                async with self.async_session_maker() as session:
+                    row = (
+                        await session.execute(
+                            select(*self.value_columns()).where(
+                                self.entry_model.key == key,
+                                self.entry_model.created_at > func.now() - timedelta(seconds=self.ttl_seconds),
+                            )
+                        )
+                    ).first()
+            except Exception as e:
+                logger.warning("Failed to read from the shared %s cache: %s", self.name, e)
+                row = None
+            if row is not None:
+                value = self.value_from_row(row)
+                self._set_local(key, value)
+                CACHE_LOOKUPS.labels(self.name, "shared").inc()
+                return value
+
+        CACHE_LOOKUPS.labels(self.name, "miss").inc()
+        return None
+
+    async def set(self, key: str, value: V):
+        self._set_local(key, value)
+        if self.async_session_maker is not None:
+            columns = self.value_to_columns(value)
+            try:
+                async with self.async_session_maker() as session:
+                    # get() ignores expired rows, but they must also be deleted for the table to stay bounded
+                    await session.execute(
+                        delete(self.entry_model).where(
+                            self.entry_model.created_at <= func.now() - timedelta(seconds=self.ttl_seconds)
+                        )
+                    )
+                    statement = insert(self.entry_model).values(key=key, **columns)
+                    await session.execute(
+                        statement.on_conflict_do_update(
+                            index_elements=[self.entry_model.key],
+                            set_={
+                                **{column: statement.excluded[column] for column in columns},
+                                "created_at": func.now(),
+                            },
+                        )
+                    )
+                    await session.commit()
+            except Exception as e:
+                logger.warning("Failed to write to the shared %s cache: %s", self.name, e)
+
+    def _set_local(self, key: str, value: V):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -1,34 +1,217 @@
+import argparse
 import asyncio
+import logging
+import os
+import random
+import time
+from datetime import timedelta
 
+import azure.identity.aio
+import openai
 from dotenv import load_dotenv
-from sqlalchemy import select
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import load_only
 
-from fastapi_app.embeddings import compute_text_embedding
+from fastapi_app.embeddings import compute_text_embeddings
 from fastapi_app.openai_clients import create_openai_embed_client
-from fastapi_app.postgres_engine import create_postgres_engine
-from fastapi_app.postgres_models import Item
+from fastapi_app.postgres_engine import create_postgres_engine_from_env
+from fastapi_app.postgres_models import BackfillCheckpoint, Item, set_embedding_dimensions
 
+logger = logging.getLogger("ragapp")
 
-async def update_embeddings():
-    engine = await create_postgres_engine()
-    openai_embed_client, openai_embed_model, openai_embed_dimensions = await create_openai_embed_client()
 
-    async with async_sessionmaker(engine, expire_on_commit=False)() as session:
-        async with session.begin():
-            items = (await session.scalars(select(Item))).all()
+async def compute_embeddings_with_retry(
+    texts: list[str], openai_embed_client, openai_embed_model, openai_embed_dimensions, max_retries: int
+) -> list[list[float]]:
+    for attempt in range(max_retries + 1):
+        try:
+            return await compute_text_embeddings(
+                texts,
+                openai_client=openai_embed_client,
+                embed_model=openai_embed_model,
+                embedding_dimensions=openai_embed_dimensions,
+            )
+        except openai.RateLimitError:
+            if attempt == max_retries:
+                raise
+            # Exponential backoff with jitter, so concurrent batches don't retry in lockstep
+            delay = min(60, 2**attempt) * random.uniform(0.5, 1.5)
+            logger.info("Rate limited, retrying in %.1f seconds...", delay)
+            await asyncio.sleep(delay)
 
-            for item in items:
-                item.embedding = await compute_text_embedding(
-                    item.to_str_for_embedding(),
-                    openai_client=openai_embed_client,
-                    embed_model=openai_embed_model,
-                    embedding_dimensions=openai_embed_dimensions,
+
+async def read_checkpoint(session_maker, name: str) -> int:
+    async with session_maker() as session:
+        last_id = await session.scalar(select(BackfillCheckpoint.last_id).where(BackfillCheckpoint.name == name))
+    return last_id or 0
+
+
+async def write_checkpoint(session_maker, name: str, last_id: int | None):
+    async with session_maker() as session:
+        if last_id is None:
+            await session.execute(delete(BackfillCheckpoint).where(BackfillCheckpoint.name == name))
+        else:
+            statement = insert(BackfillCheckpoint).values(name=name, last_id=last_id)
+            await session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[BackfillCheckpoint.name],
+                    set_={"last_id": statement.excluded.last_id, "updated_at": func.now()},
                 )
+            )
+        await session.commit()
+
+
+async def update_embeddings(
+    batch_size: int = 100,
+    concurrency: int = 4,
+    max_retries: int = 5,
+    only_stale: bool = False,
+    checkpoint_name: str = "update_embeddings",
+    restart: bool = False,
+):
+    """Recompute item embeddings, walking the items table in id order one page at a time.
+
+    Each page holds `concurrency` batches of `batch_size` items, which are embedded concurrently and committed
+    separately. After a page is done, its last id is saved as a checkpoint, so that a rerun after an interruption
+    resumes from there. The checkpoint is removed once all items are processed. If a batch fails, the error is
+    raised after its page, so the process exits with an error and the checkpoint is kept for the rerun.
+    """
+    engine = await create_postgres_engine_from_env()
+    azure_credential = (
+        azure.identity.aio.DefaultAzureCredential() if os.getenv("OPENAI_EMBED_HOST") == "azure" else None
+    )
+    openai_embed_client, openai_embed_model, openai_embed_dimensions = await create_openai_embed_client(
+        azure_credential
+    )
+    set_embedding_dimensions(openai_embed_dimensions)
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+
+    last_id = 0 if restart else await read_checkpoint(session_maker, checkpoint_name)
+    if last_id:
+        logger.info("Resuming from checkpoint %s after item %d.", checkpoint_name, last_id)
+    async with session_maker() as session:
+        total_count = await session.scalar(select(func.count()).select_from(Item).where(Item.id > last_id))
+
+    semaphore = asyncio.Semaphore(concurrency)
+    page_size = batch_size * concurrency
 
+    async def update_batch(batch: list[Item]):
+        async with semaphore:
+            embeddings = await compute_embeddings_with_retry(
+                [item.to_str_for_embedding() for item in batch],
+                openai_embed_client,
+                openai_embed_model,
+                openai_embed_dimensions,
+                max_retries,
+            )
+        # Commit each batch on its own so a failure only loses that batch
+        async with session_maker() as session:
+            await session.execute(
+                update(Item),
+                [
+                    {
+                        "id": item.id,
+                        "embedding": embedding,
+                        "embedding_hash": item.hash_for_embedding(),
+                        "embedding_model": openai_embed_model,
+                        "embedding_dimensions": openai_embed_dimensions,
+                    }
+                    for item, embedding in zip(batch, embeddings)
+                ],
+            )
             await session.commit()
 
+    processed_count = updated_count = 0
+    start_time = time.monotonic()
+    try:
+        while True:
+            async with session_maker() as session:
+                # Keyset pagination: seek past the last processed id instead of using OFFSET
+                page = (
+                    await session.scalars(
+                        select(Item)
+                        # Only the columns that make up the embedding text and its hash are needed
+                        .options(
+                            load_only(
+                                Item.id,
+                                Item.name,
+                                Item.description,
+                                Item.type,
+                                Item.embedding_hash,
+                                Item.embedding_model,
+                                Item.embedding_dimensions,
+                            )
+                        )
+                        .where(Item.id > last_id)
+                        .order_by(Item.id)
+                        .limit(page_size)
+                    )
+                ).all()
+            if not page:
+                break
+
+            items = page
+            if only_stale:
+                items = [item for item in page if item.embedding_is_stale(openai_embed_model, openai_embed_dimensions)]
+            results = await asyncio.gather(
+                *(update_batch(items[i : i + batch_size]) for i in range(0, len(items), batch_size)),
+                return_exceptions=True,
+            )
+            if errors := [result for result in results if isinstance(result, Exception)]:
+                # Leave the checkpoint before this page, so a rerun retries it, and fail so the job is rerun
+                logger.error("Failed to update embeddings after item %d: %s", last_id, errors[0])
+                raise errors[0]
+
+            last_id = page[-1].id
+            await write_checkpoint(session_maker, checkpoint_name, last_id)
+
+            processed_count += len(page)
+            updated_count += len(items)
+            rate = processed_count / (time.monotonic() - start_time)
+            eta = (total_count - processed_count) / rate if rate else 0
+            logger.info(
+                "Processed %d/%d items, updated %d (%.1f items/s, ETA %s)",
+                processed_count,
+                total_count,
+                updated_count,
+                rate,
+                timedelta(seconds=round(eta)),
+            )
+        await write_checkpoint(session_maker, checkpoint_name, None)
+        logger.info("Updated embeddings for %d items.", updated_count)
+    finally:
+        await engine.dispose()
+        if azure_credential is not None:
+            await azure_credential.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Recompute the embeddings of items")
+    parser.add_argument("--batch-size", type=int, help="Number of items per embeddings request", default=100)
+    parser.add_argument("--concurrency", type=int, help="Maximum concurrent embeddings requests", default=4)
+    parser.add_argument("--max-retries", type=int, help="Retries for a rate limited request", default=5)
+    parser.add_argument(
+        "--only-stale",
+        action="store_true",
+        help="Only re-embed items whose embedding text, model or dimensions changed since the last update",
+    )
+    parser.add_argument(
+        "--checkpoint-name", type=str, help="Name of the checkpoint used to resume", default="update_embeddings"
+    )
+    parser.add_argument(
+        "--restart", action="store_true", help="Ignore any saved checkpoint and start from the first item"
+    )
+    args = parser.parse_args()
+
+    await update_embeddings(
+        args.batch_size, args.concurrency, args.max_retries, args.only_stale, args.checkpoint_name, args.restart
+    )
+
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
     load_dotenv(override=True)
-    asyncio.run(update_embeddings())
+    asyncio.run(main())
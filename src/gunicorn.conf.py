@@ -1,11 +1,26 @@
 import multiprocessing
+import os
+import tempfile
 
 max_requests = 1000
 max_requests_jitter = 50
 log_file = "-"
 bind = "0.0.0.0:8000"
-workers = (multiprocessing.cpu_count() * 2) + 1
+workers = int(os.getenv("WEB_CONCURRENCY", (multiprocessing.cpu_count() * 2) + 1))
+# Workers read this to split POSTGRES_MAX_CONNECTIONS between their connection pools
+os.environ["WEB_CONCURRENCY"] = str(workers)
+# Workers write their Prometheus metrics to files in this directory, so that /metrics reports all of them.
+# prometheus_client picks its storage when first imported, so this must be set before any import of it.
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus_")
 
 worker_class = "uvicorn.workers.UvicornWorker"
 
-timeout = 600
\ No newline at end of file
+timeout = 600
+
+
+def child_exit(server, worker):
+    # Remove the in-flight gauges of exited workers from the shared metrics
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
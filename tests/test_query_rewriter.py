@@ -0,0 +1,71 @@
+import pytest
+
+from fastapi_app.query_rewriter import extract_search_arguments_from_rules
+
+BRANDS = ["AirStrider", "Daybird"]
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        (
+            "tents under $50",
+            ("tents", [{"column": "price", "comparison_operator": "<", "value": 50.0}]),
+        ),
+        (
+            "anything over $1,000",
+            ("anything", [{"column": "price", "comparison_operator": ">", "value": 1000.0}]),
+        ),
+        (
+            "jackets at most 1,299.99 dollars",
+            ("jackets", [{"column": "price", "comparison_operator": "<=", "value": 1299.99}]),
+        ),
+        (
+            "hiking boots between $20 and $40",
+            (
+                "hiking boots",
+                [
+                    {"column": "price", "comparison_operator": ">=", "value": 20.0},
+                    {"column": "price", "comparison_operator": "<=", "value": 40.0},
+                ],
+            ),
+        ),
+        (
+            "tents between $1,000 and $2,500",
+            (
+                "tents",
+                [
+                    {"column": "price", "comparison_operator": ">=", "value": 1000.0},
+                    {"column": "price", "comparison_operator": "<=", "value": 2500.0},
+                ],
+            ),
+        ),
+        (
+            "climbing shoes not from AirStrider",
+            ("climbing shoes", [{"column": "brand", "comparison_operator": "!=", "value": "AirStrider"}]),
+        ),
+        (
+            "daybird backpacks",
+            ("backpacks", [{"column": "brand", "comparison_operator": "==", "value": "Daybird"}]),
+        ),
+        ("waterproof hiking boots", ("waterproof hiking boots", [])),
+    ],
+)
+def test_extract_search_arguments_from_rules(query, expected):
+    assert extract_search_arguments_from_rules(query, BRANDS) == expected
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        # A bare number could be a size or a weight
+        "sleeping bags under 5",
+        # A malformed thousands separator isn't a price the rules understand
+        "tents over $1,0000",
+        "tents by AirStrider or Daybird",
+        "tents under $50 and over $20",
+        "anything for $30",
+    ],
+)
+def test_extract_search_arguments_from_rules_falls_back(query):
+    assert extract_search_arguments_from_rules(query, BRANDS) is None